@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+The set of nearly sold out conferences behind the announcement.
+
+A conference is nearly sold out while 0 < seats available <=
+NEARLY_SOLD_OUT_SEATS. Registrations report each committed seat change
+through seatsChanged, which adds or removes the conference only when it
+crosses that band, so the set is current without querying all
+conferences. Members are NearlySoldOut root entities (id: websafe
+conference key); memcache holds the whole set as one {wsck: name} dict,
+updated with compare-and-set. The hourly cron runs reconcile from a
+query, catching anything a lost update missed.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import NearlySoldOut
+
+NEARLY_SOLD_OUT_SEATS = 5
+MEMCACHE_NEARLY_SOLD_OUT_KEY = "NEARLY SOLD OUT"
+CAS_RETRIES = 5
+
+
+def isNearlySoldOut(seats):
+    return 0 < seats <= NEARLY_SOLD_OUT_SEATS
+
+
+def nearlySoldOut():
+    """Return {wsck: name} of the nearly sold out conferences."""
+    members = memcache.get(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+    if members is None:
+        members = dict((e.key.id(), e.name)
+                       for e in NearlySoldOut.query().fetch())
+        memcache.add(MEMCACHE_NEARLY_SOLD_OUT_KEY, members)
+    return members
+
+
+def _updateCached(update):
+    """Apply update (a function changing the dict in place) to the cached
+    set; if it keeps changing under us, drop it for readers to reload."""
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        members = client.gets(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+        if members is None:
+            return
+        update(members)
+        if client.cas(MEMCACHE_NEARLY_SOLD_OUT_KEY, members):
+            return
+    memcache.delete(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+
+
+def seatsChanged(conf, seats):
+    """Record that conf now has seats available, moving it in or out of
+    the set if it crossed the nearly sold out band."""
+    # only a change ending in 0..NEARLY_SOLD_OUT_SEATS + 1 can cross it
+    if seats > NEARLY_SOLD_OUT_SEATS + 1:
+        return
+    wsck = conf.key.urlsafe()
+    if isNearlySoldOut(seats) == (wsck in nearlySoldOut()):
+        return
+    if isNearlySoldOut(seats):
+        NearlySoldOut(id=wsck, name=conf.name).put()
+        _updateCached(lambda members: members.update({wsck: conf.name}))
+    else:
+        ndb.Key(NearlySoldOut, wsck).delete()
+        _updateCached(lambda members: members.pop(wsck, None))
+
+
+def reconcile(confs):
+    """Replace the set with confs (found nearly sold out by a query);
+    return the new {wsck: name}."""
+    members = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+    stale = [key for key in NearlySoldOut.query().fetch(keys_only=True)
+             if key.id() not in members]
+    ndb.delete_multi(stale)
+    ndb.put_multi([NearlySoldOut(id=wsck, name=name)
+                   for wsck, name in members.iteritems()])
+    memcache.set(MEMCACHE_NEARLY_SOLD_OUT_KEY, members)
+    return members
+
+
+def announcement(members):
+    """Return the announcement text for the {wsck: name} set."""
+    if not members:
+        return ""
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(members.itervalues())))
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""bench_endpoints.py
+
+Benchmarks ConferenceApi methods against the local testbed stubs
+(datastore, memcache, taskqueue, urlfetch, mail).
+
+A dataset of conferences, sessions, profiles, registrations and wishlist
+entries is seeded, then each method is called repeatedly as a fresh
+request. Per call the wall time, datastore RPCs and entities/keys read are
+recorded; results are written as JSON so two runs can be compared:
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \
+        python benchmarks/bench_endpoints.py -o before.json
+    ... change things ...
+    python benchmarks/bench_endpoints.py -o after.json --baseline before.json
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta, time as dtime
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+import conference
+import speakers
+import textindex
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceQueryForm
+from models import ConferenceQueryForms
+from models import Profile
+from models import Registration
+from models import Session
+from models import WishlistEntry
+from models import TeeShirtSize
+
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin']
+TOPICS = ['Web', 'Mobile', 'Cloud', 'Data', 'Security']
+TYPES = ['lecture', 'keynote', 'workshop']
+ORGANIZER = 'organizer@example.com'
+DOMAIN = 'example.com'
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+# - - - RPC accounting - - - - - - - - - - - - - - - - - - - - - - -
+
+class RpcCounter(object):
+    """Post-call hook tallying API calls and datastore rows read."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = defaultdict(int)
+        self.read = 0
+
+    def __call__(self, service, call, request, response):
+        self.calls['%s.%s' % (service, call)] += 1
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            self.read += sum(1 for e in response.entity_list()
+                             if e.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            self.read += response.result_size()
+
+    def datastoreCalls(self):
+        return sum(n for name, n in self.calls.iteritems()
+                   if name.startswith('datastore_v3.'))
+
+
+# - - - dataset - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def seed(args):
+    """Write the dataset; return the keys benchmarks need."""
+    rnd = random.Random(args.seed)
+    o_key = ndb.Key(Profile, ORGANIZER)
+    entities = [Profile(key=o_key, displayName='Organizer',
+                        mainEmail=ORGANIZER,
+                        teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED))]
+
+    c_ids = Conference.allocate_ids(size=args.conferences, parent=o_key)[0]
+    c_keys = [ndb.Key(Conference, c_ids + i, parent=o_key)
+              for i in range(args.conferences)]
+    s_keys = []
+    for i, c_key in enumerate(c_keys):
+        start = date(2016, 1, 1) + timedelta(days=(i * 7) % 360)
+        for j in range(args.sessions):
+            s_key = ndb.Key(Session, j + 1, parent=c_key)
+            s_keys.append(s_key)
+            entities.append(Session(
+                key=s_key, sessionName='Session %d-%d' % (i, j),
+                highlights='Highlights of session %d' % j,
+                speaker='Speaker %d' % rnd.randrange(args.sessions * 2 or 1),
+                duration=rnd.choice([30, 45, 60, 90]),
+                typeOfSession=[rnd.choice(TYPES)],
+                Date=start + timedelta(days=j % 3),
+                startTime=dtime(9 + j % 8, rnd.choice([0, 30]))))
+
+    attendees = defaultdict(int)
+    for i in range(args.profiles):
+        p_key = ndb.Key(Profile, userEmail(i))
+        entities.append(Profile(key=p_key, displayName='User %d' % i,
+                                mainEmail=userEmail(i),
+                                teeShirtSize=str(TeeShirtSize.M_M)))
+        for c_key in rnd.sample(c_keys, min(args.registrations, len(c_keys))):
+            attendees[c_key] += 1
+            entities.append(Registration(key=ndb.Key(
+                Registration, c_key.urlsafe(), parent=p_key), conference=c_key))
+        for s_key in rnd.sample(s_keys, min(args.wishlist, len(s_keys))):
+            entities.append(WishlistEntry(key=ndb.Key(
+                WishlistEntry, s_key.urlsafe(), parent=p_key), session=s_key))
+
+    for i, c_key in enumerate(c_keys):
+        start = date(2016, 1, 1) + timedelta(days=(i * 7) % 360)
+        maxAttendees = max(args.profiles, 10) + rnd.randrange(100)
+        entities.append(Conference(
+            key=c_key, name='Conference %d' % i,
+            description='Benchmark conference %d' % i,
+            organizerUserId=ORGANIZER,
+            topics=rnd.sample(TOPICS, 2), city=CITIES[i % len(CITIES)],
+            startDate=start, endDate=start + timedelta(days=2),
+            month=start.month, maxAttendees=maxAttendees,
+            seatsAvailable=maxAttendees - attendees[c_key]))
+
+    for i in range(0, len(entities), 500):
+        ndb.put_multi(entities[i:i + 500])
+    textindex.indexAsync([e for e in entities
+                          if isinstance(e, (Conference, Session))]).get_result()
+    for future in speakers.addSessionsBySpeakerAsync(
+            [e for e in entities if isinstance(e, Session)]):
+        future.get_result()
+
+    # user 0 benchmarks (un)registration for a conference it isn't in
+    u_key = ndb.Key(Profile, userEmail(0))
+    registered = set(r.id() for r in
+                     Registration.query(ancestor=u_key).fetch(keys_only=True))
+    free = [c for c in c_keys if c.urlsafe() not in registered]
+    return {
+        'wsck': c_keys[0].urlsafe(),
+        'freeWsck': free[0].urlsafe() if free else None,
+    }
+
+
+# - - - cases - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def request(container, **fields):
+    return container.combined_message_class(**fields)
+
+
+def query(*filters):
+    return ConferenceQueryForms(filters=[
+        ConferenceQueryForm(field=f, operator=o, value=v)
+        for f, o, v in filters])
+
+
+def cases(keys):
+    """Yield (name, user, method name, request) for each benchmark."""
+    wsck = keys['wsck']
+    getConf = request(conference.CONF_GET_REQUEST, websafeConferenceKey=wsck)
+    yield 'queryConferences/all', None, 'queryConferences', query()
+    yield ('queryConferences/city', None, 'queryConferences',
+           query(('CITY', 'EQ', 'London')))
+    yield ('queryConferences/topic', None, 'queryConferences',
+           query(('TOPIC', 'EQ', 'Web')))
+    yield ('queryConferences/month+city', None, 'queryConferences',
+           query(('MONTH', 'EQ', '6'), ('CITY', 'EQ', 'Paris')))
+    yield ('queryConferences/maxAttendees>', None, 'queryConferences',
+           query(('MAX_ATTENDEES', 'GT', '50')))
+    yield 'getConference', None, 'getConference', getConf
+    yield 'getConferenceSessions', None, 'getConferenceSessions', getConf
+    yield ('getConferenceSessionsByType', None, 'getConferenceSessionsByType',
+           request(conference.SESS_GET_REQUEST_BY_TYPE,
+                   websafeConferenceKey=wsck, sessType='lecture'))
+    yield 'getConferenceAgenda', None, 'getConferenceAgenda', getConf
+    yield ('getSessionsInWishlist', userEmail(0), 'getSessionsInWishlist',
+           request(conference.CONF_PAGE_REQUEST))
+    yield ('getConferencesToAttend', userEmail(0), 'getConferencesToAttend',
+           request(conference.CONF_PAGE_REQUEST))
+    yield ('getConferencesCreated', ORGANIZER, 'getConferencesCreated',
+           request(conference.CONF_PAGE_REQUEST))
+    yield ('getConferenceAttendees', ORGANIZER, 'getConferenceAttendees',
+           request(conference.CONF_PAGE_GET_REQUEST, websafeConferenceKey=wsck))
+    yield ('getSessionsBySpeaker', None, 'getSessionsBySpeaker',
+           request(conference.SESS_GET_REQUEST_BY_SPEAKER, speaker='speaker 1'))
+    yield ('getSpeakers', None, 'getSpeakers',
+           request(conference.CONF_PAGE_REQUEST))
+    yield ('searchConferences', None, 'searchConferences',
+           request(conference.SEARCH_REQUEST, q='conf benchmark'))
+    yield ('searchSessions', None, 'searchSessions',
+           request(conference.SEARCH_REQUEST, q='highlights sess'))
+    yield ('getProfile', userEmail(0), 'getProfile',
+           message_types.VoidMessage())
+    if keys['freeWsck']:
+        reg = request(conference.CONF_GET_REQUEST,
+                      websafeConferenceKey=keys['freeWsck'])
+        # alternate so each registration has a matching unregistration
+        yield ('registerForConference', userEmail(0),
+               ('registerForConference', 'unregisterFromConference'), reg)
+
+
+def login(email):
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = DOMAIN
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(name, user, methods, req, args, counter):
+    """Call methods args.iterations times; return the result record."""
+    if isinstance(methods, basestring):
+        methods = (methods,)
+    samples = dict((m, []) for m in methods)
+    login(user)
+    for i in range(args.warmup + args.iterations):
+        for method in methods:
+            if args.cold:
+                memcache.flush_all()
+            # each call is a new request: new api instance, empty ndb cache
+            ndb.get_context().clear_cache()
+            api = ConferenceApi()
+            counter.reset()
+            start = time.time()
+            getattr(api, method)(req)
+            elapsed = time.time() - start
+            if i >= args.warmup:
+                samples[method].append((elapsed, counter.datastoreCalls(),
+                                        counter.read, dict(counter.calls)))
+    records = []
+    for method in methods:
+        got = samples[method]
+        walls = [s[0] * 1000 for s in got]
+        rpcs = defaultdict(int)
+        for s in got:
+            for call, n in s[3].iteritems():
+                rpcs[call] += n
+        records.append({
+            'name': name if len(methods) == 1 else method,
+            'method': method,
+            'calls': len(got),
+            'wall_ms': {
+                'mean': sum(walls) / len(walls),
+                'p50': percentile(walls, 0.5),
+                'p95': percentile(walls, 0.95),
+                'min': min(walls),
+                'max': max(walls),
+            },
+            'datastore_rpcs': float(sum(s[1] for s in got)) / len(got),
+            'entities_read': float(sum(s[2] for s in got)) / len(got),
+            'rpcs': dict((call, float(n) / len(got))
+                         for call, n in rpcs.iteritems()),
+        })
+    return records
+
+
+def compare(results, baseline):
+    """Print per-benchmark deltas against an earlier run."""
+    before = dict((r['name'], r) for r in baseline['results'])
+    print >> sys.stderr, '%-34s %10s %10s %8s %8s' % (
+        'benchmark', 'p50 ms', 'was', 'rpcs', 'was')
+    for r in results:
+        b = before.get(r['name'])
+        if not b:
+            continue
+        print >> sys.stderr, '%-34s %10.2f %10.2f %8.1f %8.1f' % (
+            r['name'], r['wall_ms']['p50'], b['wall_ms']['p50'],
+            r['datastore_rpcs'], b['datastore_rpcs'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--profiles', type=int, default=100)
+    parser.add_argument('--registrations', type=int, default=5,
+                        help='registrations per profile')
+    parser.add_argument('--wishlist', type=int, default=10,
+                        help='wishlisted sessions per profile')
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--cold', action='store_true',
+                        help='flush memcache before every call')
+    parser.add_argument('--only', help='run benchmarks whose name contains this')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write JSON here, not stdout')
+    parser.add_argument('--baseline', help='earlier JSON output to compare to')
+    args = parser.parse_args()
+
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.setup_env(app_id='dev~conference-bench', overwrite=True)
+    # queries see every write, as they would after it has applied
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_urlfetch_stub()
+    tb.init_mail_stub()
+
+    counter = RpcCounter()
+    # hooks must be functions or methods, not callable objects
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('bench',
+                                                         counter.__call__)
+
+    keys = seed(args)
+    results = []
+    for name, user, methods, req in cases(keys):
+        if args.only and args.only not in name:
+            continue
+        results.extend(run(name, user, methods, req, args, counter))
+    tb.deactivate()
+
+    out = {
+        'dataset': dict((k, getattr(args, k)) for k in (
+            'conferences', 'sessions', 'profiles', 'registrations',
+            'wishlist', 'seed')),
+        'options': {'iterations': args.iterations, 'warmup': args.warmup,
+                    'cold': args.cold},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+    else:
+        json.dump(out, sys.stdout, indent=2, sort_keys=True)
+        print
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
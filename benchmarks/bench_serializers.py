@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""bench_serializers.py
+
+Microbenchmarks: compiled serializers vs. the reflection-based
+_copy*ToForm functions they replaced.
+
+Needs the App Engine Python SDK; point APPENGINE_SDK at it (or put it on
+sys.path) and run from the app directory:
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \
+        python benchmarks/bench_serializers.py -n 2000
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import date, time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+os.environ.setdefault('APPLICATION_ID', 'dev~bench')
+
+from google.appengine.ext import ndb
+
+import serializers
+# importing the api registers the special fields of each pair
+import conference
+from models import Conference, ConferenceForm
+from models import Session, SessionForm
+from models import Profile, ProfileForm
+from models import TeeShirtSize
+
+
+# - - - legacy reflection copies, as they stood before serializers - - -
+
+def legacyConference(conf, displayName):
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def legacySession(sess):
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(sess, field.name):
+            if field.name.endswith('Date'):
+                setattr(sf, field.name, str(getattr(sess, field.name)))
+            elif field.name.endswith('Time'):
+                setattr(sf, field.name, str(getattr(sess, field.name)))
+            else:
+                setattr(sf, field.name, getattr(sess, field.name))
+        elif field.name == "confwebsafeKey":
+            setattr(sf, field.name, sess.key.urlsafe())
+    sf.check_initialized()
+    return sf
+
+
+def legacyProfile(prof):
+    pf = ProfileForm()
+    for field in pf.all_fields():
+        if hasattr(prof, field.name):
+            if field.name == 'teeShirtSize':
+                setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
+            else:
+                setattr(pf, field.name, getattr(prof, field.name))
+    pf.check_initialized()
+    return pf
+
+
+# - - - fixtures - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def makeEntities(n):
+    p_key = ndb.Key(Profile, 'organizer')
+    confs, sessions, profiles = [], [], []
+    for i in range(n):
+        c_key = ndb.Key(Conference, i + 1, parent=p_key)
+        confs.append(Conference(
+            key=c_key, name='Conference %d' % i, description='About %d' % i,
+            organizerUserId='organizer', topics=['Web', 'Mobile'],
+            city='London', startDate=date(2016, 5, 1),
+            endDate=date(2016, 5, 3), month=5, maxAttendees=100,
+            seatsAvailable=42))
+        sessions.append(Session(
+            key=ndb.Key(Session, i + 1, parent=c_key),
+            sessionName='Session %d' % i, highlights='Highlights',
+            speaker='Speaker %d' % (i % 10), duration=60,
+            typeOfSession=['lecture'], Date=date(2016, 5, 2),
+            startTime=time(9, 30)))
+        profiles.append(Profile(
+            key=ndb.Key(Profile, 'user%d' % i), displayName='User %d' % i,
+            mainEmail='user%d@example.com' % i,
+            teeShirtSize=str(TeeShirtSize.M_M)))
+    return confs, sessions, profiles
+
+
+def check(legacy, compiled):
+    """The compiled path must produce the same messages."""
+    for old, new in zip(legacy, compiled):
+        assert old == new, (old, new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-n', type=int, default=1000,
+                        help='entities per listing (default 1000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timing repetitions, best is reported')
+    args = parser.parse_args()
+
+    confs, sessions, profiles = makeEntities(args.n)
+    cases = [
+        ('conference',
+         lambda: [legacyConference(c, '') for c in confs],
+         lambda: serializers.serialize_many(confs, ConferenceForm)),
+        ('session',
+         lambda: [legacySession(s) for s in sessions],
+         lambda: serializers.serialize_many(sessions, SessionForm)),
+        ('profile',
+         lambda: [legacyProfile(p) for p in profiles],
+         lambda: serializers.serialize_many(profiles, ProfileForm)),
+    ]
+
+    print '%-12s %12s %12s %8s' % ('kind', 'legacy us', 'compiled us',
+                                   'speedup')
+    for name, legacy, compiled in cases:
+        check(legacy(), compiled())
+        old = min(timeit.repeat(legacy, number=1, repeat=args.repeat))
+        new = min(timeit.repeat(compiled, number=1, repeat=args.repeat))
+        print '%-12s %12.1f %12.1f %7.1fx' % (
+            name, old / args.n * 1e6, new / args.n * 1e6, old / new)
+
+
+if __name__ == '__main__':
+    main()
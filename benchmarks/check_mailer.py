@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""check_mailer.py
+
+Checks mailer.sendBatch against the testbed taskqueue stub (which knows
+the pull queue from queue.yaml) and a fake mail service recording what
+would have been sent: messages are grouped into one digest per
+recipient, sending stops at the per-minute quota and at an over quota
+error, and only the tasks whose digest went out are deleted.
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \
+        python benchmarks/check_mailer.py
+
+"""
+
+import json
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+from google.appengine.runtime import apiproxy_errors
+
+import mailer
+
+
+class FakeMail(object):
+    """Stands in for mail.send_mail: records each email, and raises
+    OverQuotaError once `quota` emails have been sent."""
+
+    def __init__(self, quota=None):
+        self.sent = []
+        self.quota = quota
+
+    def __call__(self, sender, to, subject, body):
+        if self.quota is not None and len(self.sent) >= self.quota:
+            raise apiproxy_errors.OverQuotaError('mail quota')
+        self.sent.append((to, subject, body))
+
+
+def queued(tb):
+    """Return {recipient: number of tasks} still on the mail queue."""
+    stub = tb.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    counts = {}
+    for task in stub.get_filtered_tasks(queue_names=[mailer.MAIL_QUEUE]):
+        # the stub drops tags; queueAll puts the recipient in the body
+        to = json.loads(task.payload)['body'].split()[-1]
+        counts[to] = counts.get(to, 0) + 1
+    return counts
+
+
+def queueAll(emails):
+    for to, count in emails:
+        for i in range(count):
+            mailer.queueMail(to, 'Subject %d' % i, 'Body %d to %s' % (i, to))
+
+
+def checkDigests(tb, fake):
+    queueAll([('a@example.com', 3), ('b@example.com', 1),
+              ('c@example.com', 2)])
+    sent, more = mailer.sendBatch()
+    assert (sent, more) == (3, False), (sent, more)
+    byRecipient = dict((to, (subject, body)) for to, subject, body in fake.sent)
+    assert len(fake.sent) == 3, fake.sent
+    assert byRecipient['a@example.com'][0] == \
+        '3 updates from Conference Central', byRecipient['a@example.com']
+    assert byRecipient['a@example.com'][1].count('Body') == 3
+    # a single message goes out as it was queued
+    assert byRecipient['b@example.com'] == ('Subject 0',
+                                            'Body 0 to b@example.com')
+    assert queued(tb) == {}, queued(tb)
+
+
+def checkThrottle(tb, fake):
+    queueAll([('a@example.com', 2), ('b@example.com', 1),
+              ('c@example.com', 1)])
+    limit = mailer.MAILS_PER_MINUTE
+    mailer.MAILS_PER_MINUTE = 2
+    try:
+        sent, more = mailer.sendBatch()
+    finally:
+        mailer.MAILS_PER_MINUTE = limit
+    assert (sent, more) == (2, False), (sent, more)
+    assert len(fake.sent) == 2, fake.sent
+    # the recipient over the quota keeps its task; the others' are gone
+    unsent = set(['a@example.com', 'b@example.com', 'c@example.com']) - \
+        set(to for to, _, _ in fake.sent)
+    assert queued(tb) == dict((to, 1) for to in unsent), queued(tb)
+
+
+def checkOverQuota(tb, fake):
+    fake.quota = 1
+    queueAll([('a@example.com', 1), ('b@example.com', 2),
+              ('c@example.com', 1)])
+    sent, more = mailer.sendBatch()
+    assert (sent, more) == (1, False), (sent, more)
+    unsent = set(['a@example.com', 'b@example.com', 'c@example.com']) - \
+        set(to for to, _, _ in fake.sent)
+    expected = dict((to, 2 if to == 'b@example.com' else 1) for to in unsent)
+    assert queued(tb) == expected, queued(tb)
+
+
+def main():
+    checks = [checkDigests, checkThrottle, checkOverQuota]
+    for check in checks:
+        tb = testbed.Testbed()
+        tb.activate()
+        tb.setup_env(app_id='dev~conference-check', overwrite=True)
+        tb.init_memcache_stub()
+        tb.init_taskqueue_stub(root_path=APP_DIR)
+        fake = FakeMail()
+        send_mail = mailer.mail.send_mail
+        mailer.mail.send_mail = fake
+        try:
+            memcache.flush_all()
+            check(tb, fake)
+        finally:
+            mailer.mail.send_mail = send_mail
+            tb.deactivate()
+        print 'ok  %s' % check.__name__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""check_speakers.py
+
+Checks that featured speakers are counted like the speaker directory:
+sessions whose speaker is written in different case or spacing are
+counted on one ConferenceSpeaker (run through the add_featured_speaker
+task handler), which then features the speaker, and getSessionsBySpeaker
+finds the same sessions.
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \
+        python benchmarks/check_speakers.py
+
+"""
+
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import webapp2
+
+NAMES = [u'Guido van Rossum', u'Guido  van Rossum', u'guido van rossum',
+         u' GUIDO van\tRossum ']
+
+
+def seed():
+    """Return (conference key, session keys) of a conference with one
+    session per spelling in NAMES."""
+    from models import Conference, Profile, Session
+    import speakers
+    c_key = ndb.Key(Conference, 1, parent=ndb.Key(Profile, 'organizer'))
+    Conference(key=c_key, name=u'PyCon', organizerUserId='organizer').put()
+    sessions = [Session(parent=c_key, sessionName=u'Talk %d' % index,
+                        speaker=name)
+                for index, name in enumerate(NAMES)]
+    ndb.put_multi(sessions)
+    ndb.Future.wait_all(speakers.addSessionsBySpeakerAsync(sessions))
+    return c_key, [sess.key for sess in sessions]
+
+
+def countAll(c_key, s_keys):
+    import main
+    for s_key, name in zip(s_keys, NAMES):
+        request = webapp2.Request.blank('/tasks/add_featured_speaker', POST={
+            'websafeConferenceKey': c_key.urlsafe(),
+            'websafeSessionKey': s_key.urlsafe(),
+            'speakerName': name.encode('utf-8'),
+            'sessionName': s_key.get().sessionName})
+        response = request.get_response(main.app)
+        assert response.status_int == 200, response.status
+
+
+def checkOneCounter():
+    from models import ConferenceSpeaker
+    c_key, s_keys = seed()
+    countAll(c_key, s_keys)
+    counters = ConferenceSpeaker.query(ancestor=c_key).fetch()
+    assert len(counters) == 1, [c.key for c in counters]
+    counter = counters[0]
+    assert counter.key.id() == u'guido van rossum', counter.key
+    assert counter.speaker == u'Guido van Rossum', counter.speaker
+    assert counter.sessionCount == len(NAMES), counter.sessionCount
+    assert counter.sessionKeys == s_keys, counter.sessionKeys
+
+
+def checkFeatured():
+    import speakers
+    from conference import ConferenceApi, SESS_GET_REQUEST_BY_SPEAKER
+    c_key, s_keys = seed()
+    countAll(c_key, s_keys)
+    featured = speakers.featuredSpeaker(c_key)
+    assert featured == u'Guido van Rossum: Talk 0, Talk 1, Talk 2, Talk 3', \
+        featured
+    # every spelling finds the same sessions in the directory
+    for name in NAMES:
+        request = SESS_GET_REQUEST_BY_SPEAKER.combined_message_class(
+            speaker=name)
+        found = ConferenceApi().getSessionsBySpeaker(request)
+        assert len(found.items) == len(NAMES), (name, len(found.items))
+
+
+def main():
+    checks = [checkOneCounter, checkFeatured]
+    for check in checks:
+        tb = testbed.Testbed()
+        tb.activate()
+        tb.setup_env(app_id='dev~conference-check', overwrite=True,
+                     CURRENT_VERSION_ID='check.1')
+        tb.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        tb.init_memcache_stub()
+        tb.init_taskqueue_stub(root_path=APP_DIR)
+        try:
+            ndb.get_context().clear_cache()
+            check()
+        finally:
+            tb.deactivate()
+        print 'ok  %s' % check.__name__
+
+
+if __name__ == '__main__':
+    main()
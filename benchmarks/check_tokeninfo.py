@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""check_tokeninfo.py
+
+Checks utils.getUserIdAsync for OAuth bearer tokens against the testbed
+urlfetch stub, whose requests to tokeninfo are answered by a local fake:
+a verified token is cached for its expires_in (at most TOKEN_MAX_TTL),
+a token tokeninfo rejects is cached as invalid for INVALID_TOKEN_TTL, and
+a tokeninfo outage is retried and never cached.
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \
+        python benchmarks/check_tokeninfo.py
+
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+import urlparse
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.path.expanduser(os.environ['APPENGINE_SDK']))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+
+import utils
+
+TOKENINFO_PREFIX = utils.TOKENINFO_URL.split('?')[0]
+
+
+class FakeTokeninfo(object):
+    """Answers tokeninfo requests from `tokens`, {token: (status,
+    content)}, and records the (token type, token) of each request."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.requests = []
+
+    def __call__(self, url, payload, method, headers, request, response,
+                 **kwargs):
+        query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+        token_type, token = query.items()[0][0], query.items()[0][1][0]
+        self.requests.append((token_type, token))
+        status, content = self.tokens[token]
+        response.set_statuscode(status)
+        response.set_content(content)
+
+
+def isTokeninfo(url):
+    return url.startswith(TOKENINFO_PREFIX)
+
+
+def userId(token):
+    """Return getUserIdAsync's answer for a request bearing token."""
+    os.environ['HTTP_AUTHORIZATION'] = 'Bearer %s' % token
+    return utils.getUserIdAsync(None, 'oauth').get_result()
+
+
+def cached(token):
+    """Return (userId, seconds to expiry) memcached for token, or None."""
+    entry = memcache.get(utils.MEMCACHE_TOKEN_KEY %
+                         hashlib.sha256(token).hexdigest())
+    return entry and (entry[0], entry[1] - time.time())
+
+
+def checkValid(fake):
+    fake.tokens['short'] = (200, json.dumps({'user_id': '42',
+                                             'expires_in': 120}))
+    fake.tokens['long'] = (200, json.dumps({'user_id': '43',
+                                            'expires_in': 7200}))
+    assert userId('short') == '42'
+    user, ttl = cached('short')
+    assert user == '42' and 110 < ttl <= 120, (user, ttl)
+    assert userId('long') == '43'
+    user, ttl = cached('long')
+    assert user == '43' and ttl <= utils.TOKEN_MAX_TTL, (user, ttl)
+    # later requests are answered by the instance cache, then memcache
+    assert userId('short') == '42'
+    utils._token_cache.entries.clear()
+    assert userId('short') == '42'
+    assert fake.requests == [('id_token', 'short'), ('id_token', 'long')], \
+        fake.requests
+
+
+def checkInvalid(fake):
+    fake.tokens['bad'] = (400, json.dumps({'error': 'invalid_token'}))
+    assert userId('bad') == ''
+    # rejected as an id_token, the token is tried as an access token
+    assert fake.requests == [('id_token', 'bad'), ('access_token', 'bad')], \
+        fake.requests
+    user, ttl = cached('bad')
+    assert user == '' and ttl <= utils.INVALID_TOKEN_TTL, (user, ttl)
+    utils._token_cache.entries.clear()
+    assert userId('bad') == ''
+    assert len(fake.requests) == 2, fake.requests
+
+
+def checkUnavailable(fake):
+    fake.tokens['any'] = (503, 'Service Unavailable')
+    assert userId('any') == ''
+    assert fake.requests == [('id_token', 'any')] * 3, fake.requests
+    assert cached('any') is None
+    assert utils._token_cache.get(hashlib.sha256('any').hexdigest()) is None
+    # nothing was cached, so the next request asks again
+    assert userId('any') == ''
+    assert len(fake.requests) == 6, fake.requests
+
+
+def main():
+    checks = [checkValid, checkInvalid, checkUnavailable]
+    for check in checks:
+        fake = FakeTokeninfo({})
+        tb = testbed.Testbed()
+        tb.activate()
+        tb.setup_env(app_id='dev~conference-check', overwrite=True)
+        tb.init_datastore_v3_stub()
+        tb.init_memcache_stub()
+        tb.init_urlfetch_stub(urlmatchers=[(isTokeninfo, fake)])
+        try:
+            utils._token_cache.entries.clear()
+            check(fake)
+        finally:
+            os.environ.pop('HTTP_AUTHORIZATION', None)
+            tb.deactivate()
+        print 'ok  %s' % check.__name__
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Read-through memcache of serialized API responses, per conference.
+
+Every conference has a version number in memcache that is part of the key
+of each cached payload. Writers bump the version instead of finding and
+deleting every payload derived from the conference; stale payloads are
+never read again and simply age out.
+
+"""
+
+import time
+
+from protorpc import protojson
+from google.appengine.api import memcache
+
+MEMCACHE_VERSION_KEY = "CONF VERSION %s"
+MEMCACHE_PAYLOAD_KEY = "CONF PAYLOAD %s %s %s"
+PAYLOAD_TTL = 60 * 60
+
+
+def _initialVersion():
+    # seeding from the clock means a version evicted from memcache never
+    # restarts at a number whose payloads may still be cached
+    return int(time.time())
+
+
+def version(wsck):
+    """Return the current cache version of conference wsck."""
+    key = MEMCACHE_VERSION_KEY % wsck
+    v = memcache.get(key)
+    if v is None:
+        v = _initialVersion()
+        if not memcache.add(key, v):
+            v = memcache.get(key) or v
+    return v
+
+
+def bumpVersion(*wscks):
+    """Invalidate every cached payload of the given conferences."""
+    memcache.offset_multi(dict((MEMCACHE_VERSION_KEY % wsck, 1)
+                               for wsck in wscks),
+                          initial_value=_initialVersion())
+
+
+def payloadKey(name, wsck, *args):
+    """Return the memcache key of payload name of conference wsck at its
+    current version.
+
+    Get and set a payload with the same key: a version bumped while the
+    payload is built then leaves it stored under the old version, where
+    it is never read.
+    """
+    return MEMCACHE_PAYLOAD_KEY % (name, wsck, version(wsck)) + \
+        ''.join(' %s' % (arg,) for arg in args)
+
+
+def getMessage(message_type, key):
+    """Return the message cached under key, or None on a miss."""
+    data = memcache.get(key)
+    if data is None:
+        return None
+    return protojson.decode_message(message_type, data)
+
+
+def setMessage(message, key):
+    """Cache message under key (from payloadKey)."""
+    memcache.set(key, protojson.encode_message(message), time=PAYLOAD_TTL)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""calendars.py
+
+iCalendar (RFC 5545) feeds of sessions: a conference's sessions and a
+user's wishlist, served by main.py a page of sessions at a time.
+
+Feeds are validated by the version of what they are built from (the
+conference's cache version, or the wishlist's own version, bumped on
+every add/remove): the ETag is derived from it, and Last-Modified is the
+time a version was first served, remembered in memcache. Calendar clients
+polling an unchanged feed get a 304 for a couple of memcache gets.
+
+Wishlist feeds are fetched by calendar clients that cannot sign in, so
+their URL carries a per-profile secret token instead (see feedToken).
+
+"""
+
+import hmac
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+
+import cache
+import schedule
+
+MEMCACHE_MODIFIED_KEY = "FEED MODIFIED %s"
+LINE_OCTETS = 75
+CRLF = '\r\n'
+
+
+def wishlistVersionId(p_key):
+    """Return the cache version id of the wishlist of profile p_key."""
+    return 'WISHLIST %s' % p_key.urlsafe()
+
+
+def touchWishlist(p_key):
+    """Mark the wishlist feed of p_key changed."""
+    cache.bumpVersion(wishlistVersionId(p_key))
+
+
+def feedToken(prof):
+    """Return the wishlist feed token of Profile prof, assigning one (not
+    stored here) if it has none yet."""
+    if not prof.calendarToken:
+        prof.calendarToken = uuid.uuid4().hex
+    return prof.calendarToken
+
+
+def checkToken(prof, token):
+    """Return True if token is the wishlist feed token of prof."""
+    return bool(prof and prof.calendarToken and token) and \
+        hmac.compare_digest(str(prof.calendarToken), str(token))
+
+
+def wishlistVersion(p_key):
+    """Return the current version of the wishlist of profile p_key."""
+    return cache.version(wishlistVersionId(p_key))
+
+
+def validators(feed, version):
+    """Return (etag, last modified in seconds since the epoch) of feed at
+    version."""
+    key = MEMCACHE_MODIFIED_KEY % feed
+    seen = memcache.get(key)
+    if seen is None or seen[0] != version:
+        seen = (version, int(time.time()))
+        memcache.set(key, seen)
+    return '%s-%s' % (feed.replace(' ', '-'), version), seen[1]
+
+
+# - - - iCalendar text - - - - - - - - - - - - - - - - - - - -
+
+def _escape(text):
+    return (text or u'').replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _line(name, value):
+    """Return the content line name:value, folded at LINE_OCTETS octets
+    (never inside a UTF-8 sequence)."""
+    data = (u'%s:%s' % (name, value)).encode('utf-8')
+    lines = []
+    while len(data) > LINE_OCTETS:
+        cut = LINE_OCTETS - (1 if lines else 0)
+        while cut and ord(data[cut]) & 0xC0 == 0x80:
+            cut -= 1
+        lines.append(data[:cut])
+        data = data[cut:]
+    lines.append(data)
+    return (CRLF + ' ').join(lines) + CRLF
+
+
+def _stamp(dt):
+    return dt.strftime('%Y%m%dT%H%M%S')
+
+
+def header(name, prodId):
+    """Return the start of a calendar called name."""
+    return ''.join([
+        _line('BEGIN', 'VCALENDAR'),
+        _line('VERSION', '2.0'),
+        _line('PRODID', '-//%s//Conference Central//EN' % prodId),
+        _line('CALSCALE', 'GREGORIAN'),
+        _line('X-WR-CALNAME', _escape(name)),
+    ])
+
+
+def footer():
+    return _line('END', 'VCALENDAR')
+
+
+def event(sess, conf, stamp, domain):
+    """Return the VEVENT of Session sess (of Conference conf, which may be
+    None), or '' if it has no date. stamp is the UTC datetime the feed
+    was last modified.
+
+    Sessions without a start time become all day events. Times are
+    floating (the conference's local time), as sessions carry no zone.
+    """
+    if sess.Date is None:
+        return ''
+    lines = [_line('BEGIN', 'VEVENT'),
+             _line('UID', '%s@%s' % (sess.key.urlsafe(), domain)),
+             _line('DTSTAMP', _stamp(stamp) + 'Z')]
+    span = schedule.sessionInterval(sess)
+    if span:
+        lines.append(_line('DTSTART', _stamp(span[0])))
+        lines.append(_line('DTEND', _stamp(span[1])))
+    elif sess.startTime is not None:
+        lines.append(_line('DTSTART', _stamp(
+            datetime.combine(sess.Date, sess.startTime))))
+    else:
+        lines.append(_line('DTSTART;VALUE=DATE', sess.Date.strftime('%Y%m%d')))
+        lines.append(_line('DTEND;VALUE=DATE',
+                           (sess.Date + timedelta(days=1)).strftime('%Y%m%d')))
+    lines.append(_line('SUMMARY', _escape(sess.sessionName)))
+    details = [conf and conf.name,
+               sess.speaker and u'Speaker: %s' % sess.speaker,
+               sess.highlights]
+    lines.append(_line('DESCRIPTION',
+                       _escape(u'\n'.join(d for d in details if d))))
+    if conf and conf.city:
+        lines.append(_line('LOCATION', _escape(conf.city)))
+    if sess.typeOfSession:
+        lines.append(_line('CATEGORIES',
+                           ','.join(_escape(t) for t in sess.typeOfSession)))
+    lines.append(_line('END', 'VEVENT'))
+    return ''.join(lines)
@@ -21,29 +21,72 @@ import logging
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
 from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
 from models import TeeShirtSize
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceBatchResult
+from models import SeatsForm
+from models import SeatsForms
+from models import ConferenceBatchResults
+from models import ConferenceExport
+from models import ExportForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import QueryPlanForm
 from models import BooleanMessage
 from models import ConflictException
 from models import StringMessage
 from models import Session
+from models import Speaker
+from models import SpeakerForm
+from models import SpeakerForms
 from models import SessionForm
 from models import SessionForms
-
+from models import SessionQueryForm
+from models import WishlistForms
+from models import WishlistItemForm
+from models import WishlistAddForm
+from models import SessionConflictForm
+from models import ConferenceConflictForm
+from models import ScheduleConflictsForm
+from models import SessionBatchForm
+from models import SessionBatchResult
+from models import SessionBatchResults
+from models import AgendaDayForm
+from models import AgendaForm
+from models import ConferenceAgenda
+from models import Registration
+
+import announcements
+import cache
+import calendars
+import exports
+import mailer
+import queryplanner
+import registrations
+import requeststats
+import schedule
+import seats
+import serializers
+import speakers
+import textindex
+import wishlists
 
 from settings import WEB_CLIENT_ID
 
@@ -52,8 +95,16 @@ from utils import getUserId
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT ANNOUNCEMENTS"
-MEMCACHE_SPEAKER_KEY = "FEATURED SPEAKER"
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+MEMCACHE_AGENDA_KEY = "AGENDA %s"
+AGENDA_ID = 'agenda'
+AGENDA_REBUILD_DELAY = 5
+
+PUT_CHUNK_SIZE = 500
+MAX_IMPORT_BATCH = 500
+MAX_SESSION_BATCH = 200
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -65,6 +116,29 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    cursor=messages.StringField(2),
+)
+
+CONF_PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    cursor=messages.StringField(3),
+)
+
+SEATS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKeys=messages.StringField(1, repeated=True),
+)
+
+SESS_POST_BULK_REQUEST = endpoints.ResourceContainer(
+    SessionBatchForm,
+    websafeConferenceKey=messages.StringField(2),
+)
+
 SESS_GET_REQUEST_BY_TYPE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -91,6 +165,19 @@ ADD_WISHLIST_POST = endpoints.ResourceContainer(
     sess_key=messages.StringField(1),
 )
 
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    cursor=messages.StringField(3),
+    websafeConferenceKey=messages.StringField(4),
+)
+
+EXPORT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeExportKey=messages.StringField(1),
+)
+
 RETURN_FEATURED_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
@@ -119,6 +206,49 @@ FIELDS = {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# fields whose value isn't a same-named property, compiled once per pair
+serializers.register(Conference, ConferenceForm,
+                     websafeKey=lambda conf: conf.key.urlsafe())
+serializers.register(Session, SessionForm,
+                     confwebsafeKey=lambda sess: sess.key.urlsafe())
+serializers.register(ConferenceExport, ExportForm,
+                     websafeExportKey=lambda job: job.key.urlsafe(),
+                     websafeConferenceKey=lambda job: job.conference.urlsafe(),
+                     attendeesUrl=lambda job: exports.downloadUrl(
+                         job, 'attendees') if job.done else None,
+                     sessionsUrl=lambda job: exports.downloadUrl(
+                         job, 'sessions') if job.done else None)
+serializers.register(Profile, ProfileForm,
+                     teeShirtSize=lambda prof: getattr(TeeShirtSize, prof.teeShirtSize),
+                     conferenceKeysToAttend=None)
+
+
+@ndb.tasklet
+def fetchParallel(**sources):
+    """Wait on named sources concurrently; return a dict of their results.
+
+    A source is an ndb.Key (fetched with get_async) or a Future. Handlers
+    declare what they need up front:
+
+        got = yield fetchParallel(conf=c_key, prof=c_key.parent())
+    """
+    names = sources.keys()
+    futures = [source.get_async() if isinstance(source, ndb.Key) else source
+               for source in sources.values()]
+    results = yield futures
+    raise ndb.Return(dict(zip(names, results)))
+
+
+@ndb.tasklet
+def addTasksAsync(tasks, queue_name='default'):
+    """Enqueue a Task (or list of Tasks) in one Queue.add call.
+
+    Returns a Future, so the enqueue can be yielded together with ndb
+    futures (a bare taskqueue RPC cannot be).
+    """
+    result = yield taskqueue.Queue(queue_name).add_async(tasks)
+    raise ndb.Return(result)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 @endpoints.api(name='conference',
@@ -136,21 +266,30 @@ class ConferenceApi(remote.Service):
         """Create new Session endpoint."""
         return self._createSessionObject(request)
 
-    def _createSessionObject(self, request):
-        """Create Session object, returning SessionForm/request."""
-        # preload necessary data items
+    def _requireUser(self):
+        """Return the current user, or raise if nobody is signed in."""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        return user
+
+    def _checkSessionOrganizer(self, wsck, conf, action='create Sessions'):
+        """Return Conference conf (wsck) if the current user organizes it."""
+        # preload necessary data items
+        user_id = getUserId(self._requireUser())
 
-        conf = ndb.Key(urlsafe=request.confwebsafeKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
         organizerId = conf.organizerUserId
 
         # session creation open only to the organizer of the conference
         if user_id != organizerId:
-            raise endpoints.UnauthorizedException('User not Organizer of Conference, Cannot create Sessions')
+            raise endpoints.UnauthorizedException('User not Organizer of Conference, Cannot %s' % action)
+        return conf
 
+    def _sessionData(self, request):
+        """Validate SessionForm & copy it into a dict of Session properties."""
         # session must have a name
         if not request.sessionName:
             raise endpoints.BadRequestException("Session 'name' field required")
@@ -159,36 +298,115 @@ class ConferenceApi(remote.Service):
         if not request.speaker:
             raise endpoints.BadRequestException("Session 'speaker' field required")
 
-        # getFeauturedSpeaker implementation as Task
-        speakerName = request.speaker
-        taskqueue.add(params={'speakerName': speakerName},
-                      url='/tasks/add_featured_speaker')
-
         # copy SessionForm/ProtoRPC Message into dictionary
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['confwebsafeKey']
 
-        # convert date from strings to Date objects
-        if data['Date']:
-            data['Date'] = datetime.strptime(data['Date'][:10], "%Y-%m-%d").date()
-
-        # convert time from strings to time object
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'][:10], "%H:%M").time()
+        try:
+            # convert date from strings to Date objects
+            if data['Date']:
+                data['Date'] = datetime.strptime(data['Date'][:10], "%Y-%m-%d").date()
+
+            # convert time from strings to time object
+            if data['startTime']:
+                data['startTime'] = datetime.strptime(data['startTime'][:10], "%H:%M").time()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Session 'Date' must be YYYY-MM-DD and 'startTime' HH:MM")
+        return data
+
+    def _featuredSpeakerTask(self, request, s_key):
+        """Return the Task counting a new session for its speaker."""
+        return taskqueue.Task(params={'websafeConferenceKey': request.confwebsafeKey,
+                                      'speakerName': request.speaker,
+                                      'websafeSessionKey': s_key.urlsafe(),
+                                      'sessionName': request.sessionName},
+                              url='/tasks/add_featured_speaker')
+
+    @ndb.synctasklet
+    def _createSessionObject(self, request):
+        """Create Session object, returning SessionForm/request."""
+        wsck = request.confwebsafeKey
+        # turn away anonymous callers before any RPC
+        self._requireUser()
+
+        # fetch the Conference & allocate new Session ID with Conference key
+        # as parent in parallel
+        c_key = ndb.Key(urlsafe=wsck)
+        got = yield fetchParallel(
+            conf=c_key, ids=Session.allocate_ids_async(size=1, parent=c_key))
+        self._checkSessionOrganizer(wsck, got['conf'])
+        data = self._sessionData(request)
 
-        # create Conference key from websafe url key string
-        c_key = ndb.Key(Conference, request.confwebsafeKey)
-        # allocate new Session ID with Conference key as parent
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
         # make Session key from ID
-        s_key = ndb.Key(Session, s_id, parent=c_key)
+        s_key = ndb.Key(Session, got['ids'][0], parent=c_key)
         data['key'] = s_key
 
-        # create Session object in datastore
-        Session(**data).put()
+        # create Session object in datastore, in the search index & in its
+        # Speaker; count the session for its speaker at the conference &
+        # maybe feature them, as Task
+        sess = Session(**data)
+        yield (sess.put_async(),
+               textindex.indexAsync([sess]),
+               speakers.addSessionsAsync(sess.speaker, [s_key]),
+               addTasksAsync(self._featuredSpeakerTask(request, s_key)),
+               self._queueAgendaRebuild(wsck))
+        cache.bumpVersion(wsck)
 
         # return (modified) SessionForm
-        return request
+        raise ndb.Return(request)
+
+    @endpoints.method(SESS_POST_BULK_REQUEST, SessionBatchResults,
+                      path='conference/{websafeConferenceKey}/sessions',
+                      http_method='POST', name='createSessions')
+    @ndb.synctasklet
+    def createSessions(self, request):
+        """Create many Sessions of one conference in a single batch.
+
+        Invalid items are reported per item and the valid ones are still
+        created.
+        """
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = self._checkSessionOrganizer(wsck, (yield c_key.get_async()))
+        if len(request.items) > MAX_SESSION_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d sessions per batch' % MAX_SESSION_BATCH)
+
+        results = []
+        valid = []
+        for index, form in enumerate(request.items):
+            form.confwebsafeKey = wsck
+            result = SessionBatchResult(index=index)
+            try:
+                valid.append((form, self._sessionData(form)))
+                result.session = form
+            except endpoints.BadRequestException as e:
+                result.error = e.message
+            results.append(result)
+
+        if valid:
+            # allocate one ID range under the Conference key for the batch
+            first, last = yield Session.allocate_ids_async(size=len(valid),
+                                                           parent=conf.key)
+            sessions = []
+            tasks = []
+            for s_id, (form, data) in zip(range(first, last + 1), valid):
+                data['key'] = ndb.Key(Session, s_id, parent=conf.key)
+                sessions.append(Session(**data))
+                tasks.append(self._featuredSpeakerTask(form, data['key']))
+
+            # write the sessions while counting them for their speakers, in
+            # as few Queue.add calls as the per-call task limit allows
+            yield ([ndb.put_multi_async(sessions),
+                    textindex.indexAsync(sessions),
+                    self._queueAgendaRebuild(wsck)] +
+                   speakers.addSessionsBySpeakerAsync(sessions) +
+                   [addTasksAsync(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+                    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD)])
+            cache.bumpVersion(wsck)
+
+        raise ndb.Return(SessionBatchResults(items=results))
 
     """
     getConferenceSessions(websafeConferenceKey)
@@ -199,36 +417,29 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Return requested sessions of Conference (by websafeConferenceKey)."""
+        wsck = request.websafeConferenceKey
+        cacheKey = cache.payloadKey('sessions', wsck)
+        sf = cache.getMessage(SessionForms, cacheKey)
+        if sf is not None:
+            return sf
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = ndb.Key(urlsafe=wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
+                'No conference found with key: %s' % wsck)
 
-        # make Conference key
-        c_key = ndb.Key(Conference, request.websafeConferenceKey)
         # create ancestor query for this conference
+        c_key = conf.key
         sessionsAll = Session.query(ancestor=c_key)
         # return SessionForms
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsAll])
+        sf = SessionForms(items=serializers.serialize_many(sessionsAll, SessionForm))
+        cache.setMessage(sf, cacheKey)
+        return sf
 
     def _copySessionToForm(self, sess):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                elif field.name.endswith('Time'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-            elif field.name == "confwebsafeKey":
-                setattr(sf, field.name, sess.key.urlsafe())
-        sf.check_initialized()
-        return sf
+        return serializers.serialize(sess, SessionForm)
 
     """
     getConferenceSessionsByType(websafeConferenceKey, typeOfSession)
@@ -239,35 +450,70 @@ class ConferenceApi(remote.Service):
                       path='conference/{websafeConferenceKey}/sessionsbyType',
                       http_method='GET', name='getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
+        wsck = request.websafeConferenceKey
+        cacheKey = cache.payloadKey('sessionsByType', wsck, request.sessType)
+        sf = cache.getMessage(SessionForms, cacheKey)
+        if sf is not None:
+            return sf
+
         # check if conference exists
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = ndb.Key(urlsafe=wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
+                'No conference found with key: %s' % wsck)
 
-        # make Conference key
-        c_key = ndb.Key(Conference, request.websafeConferenceKey)
         # create ancestor query for this conference
+        c_key = conf.key
         sessionsAll = Session.query(ancestor=c_key)
         sessionsType = sessionsAll.filter(Session.typeOfSession == request.sessType)
         # return SessionForms
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsType])
+        sf = SessionForms(items=serializers.serialize_many(sessionsType, SessionForm))
+        cache.setMessage(sf, cacheKey)
+        return sf
 
     """
     getSessionsBySpeaker(speaker)
         Given a speaker, return all sessions given by this particular speaker,
-        across all conferences
+        across all conferences; the speaker name may differ in case & spacing
     """
+    @endpoints.method(SESS_GET_REQUEST_BY_SPEAKER, SessionForms,
+                      path='speaker/sessions',
+                      http_method='GET', name='getSessionsBySpeaker')
+    def getSessionsBySpeaker(self, request):
+        return self._sessionsBySpeaker(request)
+
     @endpoints.method(SESS_GET_REQUEST_BY_SPEAKER, SessionForms,
                       path='sessionsbySpeaker',
                       http_method='GET', name='getConferenceSessionsBySpeaker')
     def getConferenceSessionsBySpeaker(self, request):
-        sessionsAll = Session.query()
-        sessionsSpeaker = sessionsAll.filter(Session.speaker == request.speaker)
-        # return SessionForms
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsSpeaker])
+        """Same as getSessionsBySpeaker; kept for existing clients."""
+        return self._sessionsBySpeaker(request)
+
+    @ndb.synctasklet
+    def _sessionsBySpeaker(self, request):
+        """Return SessionForms of all sessions of request.speaker."""
+        if not speakers.normalizeSpeaker(request.speaker):
+            raise endpoints.BadRequestException("'speaker' field required")
+        # one get of the Speaker, one get_multi of their sessions
+        speaker = yield speakers.directoryKey(request.speaker).get_async()
+        sessions = []
+        if speaker:
+            sessions = yield ndb.get_multi_async(speaker.sessionKeys)
+        raise ndb.Return(SessionForms(
+            items=serializers.serialize_many(sessions, SessionForm)))
+
+    @endpoints.method(CONF_PAGE_REQUEST, SpeakerForms,
+                      path='speakers',
+                      http_method='GET', name='getSpeakers')
+    def getSpeakers(self, request):
+        """Return the speaker directory, a page at a time, by name."""
+        found, nextCursor = self._fetchPage(
+            Speaker.query().order(Speaker.key), request)
+        return SpeakerForms(
+            items=[SpeakerForm(name=speaker.name,
+                               sessionCount=speaker.sessionCount)
+                   for speaker in found],
+            nextCursor=nextCursor)
 
     """
     sessionMaxDuration(maximumDuration)
@@ -281,8 +527,7 @@ class ConferenceApi(remote.Service):
         sessionsAll = Session.query()
         sessionsLT = sessionsAll.filter(Session.duration <= request.maxDuration)
         # return SessionForms
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsLT])
+        return SessionForms(items=serializers.serialize_many(sessionsLT, SessionForm))
 
     """
     sessionsbyTime(startTime)
@@ -298,108 +543,292 @@ class ConferenceApi(remote.Service):
         sessionsAll = Session.query()
         sessionsTime = sessionsAll.filter(Session.startTime == timeObj)
         # return SessionForms
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsTime])
+        return SessionForms(items=serializers.serialize_many(sessionsTime, SessionForm))
+
+    """
+    querySessions(windows, maxDuration, includeTypes, excludeTypes)
+        Search sessions (of one conference, or all) combining start time
+        windows, a maximum duration & session types to include or exclude,
+        e.g. non-workshops before 19:00 or sessions under 60 minutes starting
+        9-12, which the datastore can't query with two inequalities
+    """
+    @endpoints.method(SessionQueryForm, SessionForms,
+                      path='querySessions',
+                      http_method='POST', name='querySessions')
+    def querySessions(self, request):
+        """Query for sessions, one page at a time; with explain set, also
+        report the query plan and how many sessions it scanned."""
+        windows = []
+        try:
+            for window in request.windows:
+                windows.append(tuple(
+                    t.hour * 60 + t.minute for t in
+                    (datetime.strptime(window.start, "%H:%M").time(),
+                     datetime.strptime(window.end, "%H:%M").time())))
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Time windows 'start' and 'end' must be HH:MM")
+        c_key = None
+        if request.websafeConferenceKey:
+            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+
+        plan = queryplanner.SessionPlan(
+            c_key, windows, request.maxDuration,
+            request.includeTypes, request.excludeTypes)
+        try:
+            start = ndb.Cursor(urlsafe=request.cursor) if request.cursor else None
+            sessions, cursor, scanned = queryplanner.streamPage(
+                plan.query(), plan.matches, self._pageSize(request),
+                start).get_result()
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid cursor.")
+
+        sf = SessionForms(items=serializers.serialize_many(sessions, SessionForm),
+                          nextCursor=cursor and cursor.urlsafe())
+        if request.explain:
+            sf.plan = QueryPlanForm(scanned=scanned, **plan.explain())
+        return sf
+
+# - - - Agenda - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _buildAgenda(self, c_key):
+        """Return AgendaForm of conference c_key: sessions sorted by
+        Date/startTime and grouped by day (undated sessions last, in a
+        day without a date)."""
+        sessions = sorted(Session.query(ancestor=c_key),
+                          key=lambda sess: (sess.Date is None, sess.Date,
+                                            sess.startTime is None,
+                                            sess.startTime, sess.sessionName))
+        toForm = serializers.serializer(Session, SessionForm)
+        days = []
+        for sess in sessions:
+            day = sess.Date and str(sess.Date)
+            if not days or days[-1].date != day:
+                days.append(AgendaDayForm(date=day))
+            days[-1].sessions.append(toForm(sess))
+        return AgendaForm(days=days)
+
+    def _storeAgenda(self, c_key):
+        """Rebuild the agenda snapshot of c_key in datastore & memcache;
+        returns it serialized."""
+        data = protojson.encode_message(self._buildAgenda(c_key))
+        ConferenceAgenda(key=ndb.Key(ConferenceAgenda, AGENDA_ID, parent=c_key),
+                         agenda=data).put()
+        memcache.set(MEMCACHE_AGENDA_KEY % c_key.urlsafe(), data)
+        return data
+
+    @ndb.tasklet
+    def _queueAgendaRebuild(self, wsck):
+        """Queue a rebuild of the agenda snapshot of wsck.
+
+        Tasks are named per conference and time bucket, so a burst of
+        session writes results in a single delayed rebuild.
+        """
+        bucket = int(time.time()) // AGENDA_REBUILD_DELAY
+        try:
+            yield taskqueue.Task(name='agenda-%s-%d' % (wsck, bucket),
+                                 params={'websafeConferenceKey': wsck},
+                                 url='/tasks/rebuild_agenda',
+                                 countdown=AGENDA_REBUILD_DELAY).add_async()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @endpoints.method(CONF_GET_REQUEST, AgendaForm,
+                      path='conference/{websafeConferenceKey}/agenda',
+                      http_method='GET', name='getConferenceAgenda')
+    def getConferenceAgenda(self, request):
+        """Return the precomputed agenda of a conference, grouped by day."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        data = memcache.get(MEMCACHE_AGENDA_KEY % c_key.urlsafe())
+        if data is None:
+            snapshot = ndb.Key(ConferenceAgenda, AGENDA_ID, parent=c_key).get()
+            if snapshot:
+                data = snapshot.agenda
+                memcache.set(MEMCACHE_AGENDA_KEY % c_key.urlsafe(), data)
+            elif c_key.get():
+                # no snapshot yet (e.g. sessions predate snapshots)
+                data = self._storeAgenda(c_key)
+            else:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % request.websafeConferenceKey)
+        return protojson.decode_message(AgendaForm, data)
 
 # - - - Wishlists - - - -  - - - - - - - - - - - - - - - - -
 # https://discussions.udacity.com/t/what-is-getfeaturedspeaker-method-supposed-to-do/18768/3
 
+    def _wishlistSessionKey(self, wssk):
+        """Return the Session key websafe wssk, or raise BadRequest."""
+        try:
+            s_key = ndb.Key(urlsafe=wssk)
+        except (TypeError, ProtocolBufferDecodeError):
+            s_key = None
+        if not s_key or s_key.kind() != 'Session':
+            raise endpoints.BadRequestException(
+                "Invalid session key: %s" % wssk)
+        return s_key
+
     """
     addSessionToWishlist(SessionKey)
         adds the session to the user's list of sessions they are interested in
-        attending
+        attending; returns false if it was already there
     """
     # wishlist is open to all conferences.
-    @endpoints.method(ADD_WISHLIST_POST, BooleanMessage,
+    @endpoints.method(ADD_WISHLIST_POST, WishlistAddForm,
                       path='addSessionToWishlist',
                       http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
-        sess = ndb.Key(urlsafe=request.sess_key).get()
+        s_key = self._wishlistSessionKey(request.sess_key)
+        sess = s_key.get()
 
         # check that session exists
         if not sess:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % request.sess_key)
-        # get user Profile
-        prof = self._getProfileFromUser()
-        # add session key to user's profile in sessionWishlistKeys
-        prof.sessionWishlistKeys.append(request.sess_key)
-        prof.put()
+        # get user Profile, storing it if this is their first write
+        prof = self._getProfileFromUser(create=True)
+        # add a WishlistEntry for the session, unless there already is one
+        added = wishlists.add(prof.key, s_key)
+        if added:
+            calendars.touchWishlist(prof.key)
+
+        # report (but allow) wishlisted sessions overlapping the new one
+        conflicts = []
+        if schedule.sessionInterval(sess):
+            others = [s for s in ndb.get_multi(
+                [k for k in wishlists.sessionKeys(prof.key) if k != s_key]) if s]
+            conflicts = schedule.conflictsWith(sess, others,
+                                               schedule.sessionInterval)
+        return WishlistAddForm(
+            data=added,
+            conflicts=serializers.serialize_many(conflicts, SessionForm))
 
-        return BooleanMessage(data=True)
+    """
+    removeSessionFromWishlist(SessionKey)
+        removes the session from the user's wishlist; returns false if it
+        was not on it
+    """
+    @endpoints.method(ADD_WISHLIST_POST, BooleanMessage,
+                      path='removeSessionFromWishlist',
+                      http_method='DELETE', name='removeSessionFromWishlist')
+    def removeSessionFromWishlist(self, request):
+        s_key = self._wishlistSessionKey(request.sess_key)
+        prof = self._getProfileFromUser()
+        removed = wishlists.remove(prof.key, s_key)
+        if removed:
+            calendars.touchWishlist(prof.key)
+        return BooleanMessage(data=removed)
 
     """
     getSessionsInWishlist()
-        query for all the sessions that the user is interested in
+        query for the sessions that the user is interested in, a page at a
+        time, each with its conference
     """
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(CONF_PAGE_REQUEST, WishlistForms,
                       path='getSessionWishlist',
                       http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         # get user profile
         prof = self._getProfileFromUser()
 
-        # get keys for all sessions in wishlist
-        sess_keys = [ndb.Key(urlsafe=sessId) for sessId in prof.sessionWishlistKeys]
-        # fetch sessions from datastore.
-        # Using get_multi(array_of_keys) to fetch all keys at once.
-        # not fetching them one by one!
-        sessionsWL = ndb.get_multi(sess_keys)
-        return SessionForms(items=[self._copySessionToForm(sess) \
-                            for sess in sessionsWL])
+        # page through the wishlist keys; each id is a websafe session key
+        e_keys, nextCursor = self._fetchPage(
+            wishlists.wishlistQuery(prof.key), request, keys_only=True)
+        sess_keys = [ndb.Key(urlsafe=e_key.id()) for e_key in e_keys]
+        conf_keys = list(set(s_key.parent() for s_key in sess_keys))
+
+        # fetch sessions and their conferences in a single batch
+        entities = ndb.get_multi(sess_keys + conf_keys)
+        sessions = entities[:len(sess_keys)]
+        # each conference is serialized once, however many sessions it has
+        confs = dict((c_key, conf and self._copyConferenceToForm(conf, ""))
+                     for c_key, conf in zip(conf_keys, entities[len(sess_keys):]))
+
+        items = []
+        for sess in sessions:
+            # skip sessions deleted since they were wishlisted
+            if not sess:
+                continue
+            items.append(WishlistItemForm(
+                websafeSessionKey=sess.key.urlsafe(),
+                session=self._copySessionToForm(sess),
+                conference=confs.get(sess.key.parent())))
+        return WishlistForms(items=items, nextCursor=nextCursor)
 
-# - - - Featured Speaker - - - - - - - - - - - - - - - - - -
+    """
+    getWishlistCalendarUrl()
+        return the URL of the user's wishlist as an iCalendar feed, to
+        subscribe to from a calendar app
+    """
+    @endpoints.method(message_types.VoidMessage, StringMessage,
+                      path='getSessionWishlist/calendar',
+                      http_method='GET', name='getWishlistCalendarUrl')
+    def getWishlistCalendarUrl(self, request):
+        prof = self._getProfileFromUser(create=True)
+        if not prof.calendarToken:
+            calendars.feedToken(prof)
+            self._putProfile(prof)
+        return StringMessage(data='https://%s/calendars/wishlist/%s/%s.ics' % (
+            app_identity.get_default_version_hostname(),
+            prof.key.urlsafe(), prof.calendarToken))
 
-    def cacheFeaturedSpeaker(self, speakerName):
-        """Create featured Speaker & assign to memcache; used by
-        createSession.
-        """
-        if speakerName:
-            memcache.set(MEMCACHE_SPEAKER_KEY, speakerName)
-        else:
-            # If there are no feat. speakers
-            # delete the memcache entry
-            memcache.delete(MEMCACHE_SPEAKER_KEY)
+    """
+    getScheduleConflicts()
+        report every pair of wishlisted sessions overlapping in time, and of
+        registered conferences sharing days
+    """
+    @endpoints.method(message_types.VoidMessage, ScheduleConflictsForm,
+                      path='schedule/conflicts',
+                      http_method='GET', name='getScheduleConflicts')
+    def getScheduleConflicts(self, request):
+        prof = self._getProfileFromUser()
+        # the whole schedule is needed to find every clash
+        entities = ndb.get_multi(
+            wishlists.sessionKeys(prof.key) +
+            [ndb.Key(urlsafe=wsck)
+             for wsck in registrations.conferenceKeysFor(prof.key)])
+        sessions = [e for e in entities if isinstance(e, Session)]
+        conferences = [e for e in entities if isinstance(e, Conference)]
+
+        toSessionForm = serializers.serializer(Session, SessionForm)
+        toConferenceForm = serializers.serializer(Conference, ConferenceForm)
+        return ScheduleConflictsForm(
+            sessions=[SessionConflictForm(
+                first=toSessionForm(first), second=toSessionForm(second),
+                overlapMinutes=int(overlap.total_seconds() // 60))
+                for first, second, overlap in schedule.overlappingPairs(
+                    sessions, schedule.sessionInterval)],
+            conferences=[ConferenceConflictForm(
+                first=toConferenceForm(first), second=toConferenceForm(second),
+                overlapDays=overlap.days)
+                for first, second, overlap in schedule.overlappingPairs(
+                    conferences, schedule.conferenceInterval)])
+
+# - - - Featured Speaker - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
                       path='getFeaturedSpeaker',
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return featured Speaker from memcache"""
-
-        # return an existing speaker from Memcache
-        featuredSpeaker = memcache.get(MEMCACHE_SPEAKER_KEY)
+        """Return featured Speaker of a conference from memcache"""
+        if not request.websafeConferenceKey:
+            raise endpoints.BadRequestException(
+                "'websafeConferenceKey' field required")
 
-        return StringMessage(data=featuredSpeaker)
+        # return the conference's speaker and their sessions from Memcache
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        return StringMessage(data=speakers.featuredSpeaker(c_key))
 
 
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
-
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        return serializers.serialize(conf, ConferenceForm,
+                                     organizerDisplayName=displayName)
 
+    def _conferenceData(self, request, user_id):
+        """Validate ConferenceForm & normalize it into a dict of Conference
+        properties, filling defaults into the outbound request as well."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
@@ -407,6 +836,7 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['expectedDemand']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -415,13 +845,17 @@ class ConferenceApi(remote.Service):
                 setattr(request, df, DEFAULTS[df])
 
         # convert dates from strings to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        try:
+            if data['startDate']:
+                data['startDate'] = datetime.strptime(data['startDate'][:10], "%Y-%m-%d").date()
+                data['month'] = data['startDate'].month
+            else:
+                data['month'] = 0
+            if data['endDate']:
+                data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Conference dates must be YYYY-MM-DD")
 
         # set seatsAvailable to be same as maxAttendees on creation
         # both for data model & outbound Message
@@ -429,23 +863,79 @@ class ConferenceApi(remote.Service):
             data["seatsAvailable"] = data["maxAttendees"]
             setattr(request, "seatsAvailable", data["maxAttendees"])
 
-        # make Profile Key from user ID
-        p_key = ndb.Key(Profile, user_id)
-        # allocate new Conference ID with Profile key as parent
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        # make Conference key from ID
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        # send email to organizer confirming conference creation
-        taskqueue.add(params={'email': user.email(),
-                      'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email')
+        # high-demand conferences spread their seats over counter shards
+        data['seatShards'] = seats.shardCount(request.expectedDemand,
+                                              data['maxAttendees'])
+        return data
+
+    @ndb.tasklet
+    def _putConferences(self, p_key, datas, c_ids=None):
+        """Create Conferences under Profile p_key from property dicts.
 
-        return request
+        IDs are allocated in one range, unless given as c_ids, and entities
+        (with any seat shards) are written with concurrent put_multi calls
+        in chunks, while the Conferences are added to the search index.
+        Tasklet returning the Conferences.
+        """
+        if c_ids is None:
+            # allocate new Conference IDs with Profile key as parent
+            first, last = yield Conference.allocate_ids_async(
+                size=len(datas), parent=p_key)
+            c_ids = range(first, last + 1)
+        confs = []
+        entities = []
+        for c_id, data in zip(c_ids, datas):
+            # make Conference key from ID
+            data['key'] = ndb.Key(Conference, c_id, parent=p_key)
+            conf = Conference(**data)
+            confs.append(conf)
+            entities.append(conf)
+            if conf.seatShards:
+                entities.extend(seats.makeShards(conf))
+
+        yield ([ndb.put_multi_async(entities[i:i + PUT_CHUNK_SIZE])
+                for i in range(0, len(entities), PUT_CHUNK_SIZE)] +
+               [textindex.indexAsync(confs)])
+        cache.bumpVersion(*[created.key.urlsafe() for created in confs])
+        # small conferences start out nearly sold out
+        for conf in confs:
+            announcements.seatsChanged(conf, conf.seatsAvailable)
+        raise ndb.Return(confs)
+
+    @staticmethod
+    def _queueImportSummary(email, names, errors=(), transactional=False):
+        """Queue one email summarizing a batch of created conferences."""
+        info = '\r\n'.join(names)
+        if errors:
+            info += '\r\n\r\nNot imported:\r\n%s' % '\r\n'.join(errors)
+        mailer.queueMail(email, 'You imported %d Conferences!' % len(names),
+                         'Hi, you have created the following '
+                         'conferences:\r\n\r\n%s' % info,
+                         transactional=transactional)
+
+    @ndb.synctasklet
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        # the organizer's Profile is the Conference's parent; store it
+        p_key = self._getProfileFromUser(create=True).key
+
+        data = self._conferenceData(request, p_key.id())
+
+        # create Conference while sending email to organizer confirming
+        # conference creation & return (modified) ConferenceForm
+        yield (self._putConferences(p_key, [data]),
+               addTasksAsync(mailer.mailTask(
+                   user.email(), 'You created a new Conference!',
+                   'Hi, you have created a following conference:\r\n\r\n%s'
+                   % repr(request)), queue_name=mailer.MAIL_QUEUE))
+
+        raise ndb.Return(request)
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
@@ -453,40 +943,189 @@ class ConferenceApi(remote.Service):
         """Create new conference."""
         return self._createConferenceObject(request)
 
+    @endpoints.method(ConferenceForms, ConferenceBatchResults,
+                      path='conferences/import',
+                      http_method='POST', name='importConferences')
+    def importConferences(self, request):
+        """Create a batch of conferences organized by the current user.
+
+        Invalid items are reported per item and the valid ones are still
+        created; one summary email is sent for the whole batch.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = self._getProfileFromUser(create=True).key.id()
+        if len(request.items) > MAX_IMPORT_BATCH:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per import batch' % MAX_IMPORT_BATCH)
+
+        results = []
+        valid = []
+        for index, form in enumerate(request.items):
+            result = ConferenceBatchResult(index=index)
+            try:
+                valid.append((result, form, self._conferenceData(form, user_id)))
+            except endpoints.BadRequestException as e:
+                result.error = e.message
+            results.append(result)
+
+        if valid:
+            confs = self._putConferences(ndb.Key(Profile, user_id),
+                                         [data for _, _, data in valid]
+                                         ).get_result()
+            for (result, form, _), conf in zip(valid, confs):
+                form.websafeKey = conf.key.urlsafe()
+                result.conference = form
+            self._queueImportSummary(user.email(),
+                                     [conf.name for conf in confs],
+                                     ['#%d: %s' % (r.index, r.error)
+                                      for r in results if r.error])
+
+        return ConferenceBatchResults(items=results)
+
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
+    @ndb.synctasklet
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        cacheKey = cache.payloadKey('conference', wsck)
+        cf = cache.getMessage(ConferenceForm, cacheKey)
+        if cf is not None:
+            # seats change too often to live in the cached form
+            cf.seatsAvailable = seats.cachedSeatsAvailable(c_key)
+            raise ndb.Return(cf)
+
+        # get Conference object and its organizer's Profile (the parent key)
+        # together; bail if not found
+        got = yield fetchParallel(conf=c_key, prof=c_key.parent())
+        conf = got['conf']
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+                'No conference found with key: %s' % wsck)
+        cf = self._copyConferenceToForm(conf, getattr(got['prof'], 'displayName', ''))
+        cache.setMessage(cf, cacheKey)
+        # return ConferenceForm, with live seats if the counter is sharded
+        cf.seatsAvailable = seats.seatsAvailable(conf)
+        raise ndb.Return(cf)
+
+    @endpoints.method(SEATS_GET_REQUEST, SeatsForms,
+                      path='conferences/seats',
+                      http_method='GET', name='getSeatsAvailable')
+    def getSeatsAvailable(self, request):
+        """Return live seats available of the given conferences (at most
+        MAX_PAGE_SIZE), for polling the conferences on screen; unknown
+        conferences are left out."""
+        if len(request.websafeConferenceKeys) > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "At most %d conferences per request." % MAX_PAGE_SIZE)
+        c_keys = []
+        for wsck in request.websafeConferenceKeys:
+            try:
+                c_key = ndb.Key(urlsafe=wsck)
+            except (TypeError, ProtocolBufferDecodeError):
+                c_key = None
+            if not c_key or c_key.kind() != 'Conference':
+                raise endpoints.BadRequestException(
+                    "Invalid conference key: %s" % wsck)
+            c_keys.append(c_key)
+
+        found = seats.cachedSeatsAvailableMulti(c_keys)
+        return SeatsForms(items=[
+            SeatsForm(websafeConferenceKey=wsck, seatsAvailable=found[key])
+            for wsck, key in zip(request.websafeConferenceKeys, c_keys)
+            if key in found])
+
+# - - - Exports - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(CONF_GET_REQUEST, ExportForm,
+                      path='conference/{websafeConferenceKey}/export',
+                      http_method='POST', name='startConferenceExport')
+    def startConferenceExport(self, request):
+        """Start exporting a conference's attendees & sessions as CSV, by
+        chained tasks; the organizer is emailed the download URLs once
+        done. Progress is reported by getConferenceExport."""
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        self._checkSessionOrganizer(wsck, c_key.get(), action='export it')
+        user = endpoints.get_current_user()
+        job = ConferenceExport(conference=c_key, organizerEmail=user.email(),
+                               token=exports.newToken())
+
+        @ndb.transactional
+        def start():
+            job.put()
+            taskqueue.add(params={'exportKey': job.key.urlsafe(), 'step': 0},
+                          url='/tasks/export_conference', transactional=True)
+        start()
+        return serializers.serialize(job, ExportForm)
+
+    @endpoints.method(EXPORT_GET_REQUEST, ExportForm,
+                      path='export/{websafeExportKey}',
+                      http_method='GET', name='getConferenceExport')
+    def getConferenceExport(self, request):
+        """Return the progress of an export (download URLs once done)."""
+        job = ndb.Key(urlsafe=request.websafeExportKey).get()
+        if not job:
+            raise endpoints.NotFoundException(
+                'No export found with key: %s' % request.websafeExportKey)
+        self._checkSessionOrganizer(job.conference.urlsafe(),
+                                    job.conference.get(), action='export it')
+        return serializers.serialize(job, ExportForm)
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @ndb.synctasklet
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        # get user Profile
-        prof = self._getProfileFromUser()
-
         # check if conf exists given websafeConfKey
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = yield ndb.Key(urlsafe=wsck).get_async()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # attendees are listed through their Profiles, so make sure the
+        # registrant's one is stored before registering
+        if reg:
+            self._getProfileFromUser(create=True)
+
+        if conf.seatShards:
+            retval = yield self._shardedRegistration(conf, reg)
+            left = None
+        else:
+            retval, left = yield self._unshardedRegistration(wsck, reg)
+
+        # only the short-lived seat count changes; the cached
+        # ConferenceForm and session payloads stay valid
+        if retval:
+            cached = seats.adjustCachedSeats(conf, -1 if reg else 1)
+            if left is None:
+                left = cached if cached is not None else \
+                    seats.countSeatsAvailable(conf)
+            announcements.seatsChanged(conf, left)
+        raise ndb.Return(BooleanMessage(data=retval))
+
+    @ndb.transactional_tasklet(xg=True)
+    def _unshardedRegistration(self, wsck, reg):
+        """Register or unregister user, counting seats on the Conference.
+
+        Returns (changed, seats available afterwards).
+        """
+        retval = None
+        # get user Profile and their Registration for this conference
+        prof = self._getProfileFromUser()
+        r_key = registrations.registrationKey(prof.key, wsck)
+        conf, registration = yield ndb.get_multi_async([ndb.Key(urlsafe=wsck),
+                                                        r_key])
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -496,26 +1135,82 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            yield ndb.put_multi_async([Registration(key=r_key,
+                                                    conference=conf.key), conf])
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
+                yield r_key.delete_async(), conf.put_async()
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        raise ndb.Return((retval, conf.seatsAvailable))
+
+    @ndb.tasklet
+    def _shardedRegistration(self, conf, reg):
+        """Register or unregister user, counting seats on a SeatShard.
+
+        Shards are tried in random order so concurrent registrants land on
+        different entity groups; the conference is only full once every
+        shard is.
+        """
+        wsck = conf.key.urlsafe()
+        for shard_key in seats.candidateShards(conf, reg):
+            try:
+                retval = yield self._shardRegistrationTxn(wsck, shard_key, reg)
+            except seats.ShardUnavailable:
+                continue
+            raise ndb.Return(retval)
+
+        if reg:
+            # still report a repeat registration as such, not as sold out
+            p_key = self._getProfileFromUser().key
+            registration = yield registrations.registrationKey(p_key, wsck).get_async()
+            if registration:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            raise ConflictException(
+                "There are no seats available.")
+        # no shard holds a seat, so nobody (this user included) is registered
+        raise ndb.Return(False)
+
+    @ndb.transactional_tasklet(xg=True)
+    def _shardRegistrationTxn(self, wsck, shard_key, reg):
+        """Move one seat between shard_key and the user's Registration."""
+        # get user Profile and their Registration for this conference
+        prof = self._getProfileFromUser()
+        r_key = registrations.registrationKey(prof.key, wsck)
+        shard, registration = yield ndb.get_multi_async([shard_key, r_key])
+
+        if reg:
+            # check if user already registered otherwise add
+            if registration:
+                raise ConflictException(
+                    "You have already registered for this conference")
+            # another registrant may have taken the last seat of this shard
+            if shard.seatsTaken >= shard.capacity:
+                raise seats.ShardUnavailable()
+            shard.seatsTaken += 1
+            yield ndb.put_multi_async([Registration(key=r_key,
+                                                    conference=ndb.Key(urlsafe=wsck)),
+                                       shard])
+        else:
+            if not registration:
+                raise ndb.Return(False)
+            if shard.seatsTaken <= 0:
+                raise seats.ShardUnavailable()
+            shard.seatsTaken -= 1
+            yield r_key.delete_async(), shard.put_async()
+
+        raise ndb.Return(True)
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
@@ -531,7 +1226,7 @@ class ConferenceApi(remote.Service):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
@@ -539,60 +1234,117 @@ class ConferenceApi(remote.Service):
         # get user profile
         prof = self._getProfileFromUser()
 
-        # get conferenceKeysToAttend from profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
+        # page through the user's Registration keys; each id is a websafe
+        # conference key so no Registration entity needs to be loaded
+        r_keys, nextCursor = self._fetchPage(
+            registrations.conferenceQuery(prof.key), request, keys_only=True)
+        conf_keys = [ndb.Key(urlsafe=r_key.id()) for r_key in r_keys]
         # fetch conferences from datastore.
         # Use get_multi(array_of_keys) to fetch all keys at once.
         # Do not fetch them one by one!
         conferences = ndb.get_multi(conf_keys)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, "") \
-                               for conf in conferences])
+        return ConferenceForms(items=serializers.serialize_many(conferences, ConferenceForm),
+                               nextCursor=nextCursor)
+
+    @endpoints.method(CONF_PAGE_GET_REQUEST, ProfileForms,
+                      path='conference/{websafeConferenceKey}/attendees',
+                      http_method='GET', name='getConferenceAttendees')
+    @ndb.synctasklet
+    def getConferenceAttendees(self, request):
+        """Return registered attendees of a conference; organizer only."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+
+        # a Registration's parent is the attendee's Profile; page through
+        # them while checking the conference & its organizer
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        got = yield fetchParallel(
+            conf=c_key,
+            page=self._fetchPageAsync(registrations.attendeeQuery(c_key),
+                                      request, keys_only=True))
+        conf = got['conf']
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if getUserId(user) != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can list attendees.')
+
+        r_keys, nextCursor = got['page']
+        profiles = yield ndb.get_multi_async([r_key.parent() for r_key in r_keys])
+        raise ndb.Return(ProfileForms(
+            items=serializers.serialize_many(profiles, ProfileForm),
+            nextCursor=nextCursor))
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
+    def _copyProfileToForm(self, prof, conferenceKeys=()):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
-
-    def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
+        # registrations are Registration entities, passed in by caller
+        return serializers.serialize(
+            prof, ProfileForm, conferenceKeysToAttend=list(conferenceKeys))
+
+    def _getProfileFromUser(self, create=False):
+        """Return user Profile from datastore.
+
+        A user without a stored Profile gets an unsaved one built from their
+        login data, so read-only endpoints never write; writers pass
+        create=True to store it. The Profile is memoized for the rest of the
+        request, and ndb keeps it in memcache across requests.
+        """
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
 
-        # get Profile from datastore
+        # get Profile from the request memo, else from memcache/datastore
         user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-
-        # get the entity from datastore by using get() on the key
-        profile = p_key.get()
-
-        # create a new Profile from logged in user data
-        if not profile:
-            profile = Profile(
-                userId=None,
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
+        memo = getattr(self, '_profileMemo', None)
+        if memo and memo.key.id() == user_id:
+            profile = memo
+        else:
+            self._profileStored = True
+            p_key = ndb.Key(Profile, user_id)
+
+            # get the entity from datastore by using get() on the key
+            profile = p_key.get()
+
+            # create a new Profile from logged in user data
+            if not profile:
+                profile = Profile(
+                    userId=None,
+                    key=p_key,
+                    displayName=user.nickname(),
+                    mainEmail=user.email(),
+                    teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+                )
+                self._profileStored = False
+
+            elif profile.conferenceKeysToAttend or profile.sessionWishlistKeys:
+                # move registrations & wishlist still held in the legacy lists
+                # onto their own entities the first time the profile is seen
+                registrations.migrateProfile(p_key)
+                if wishlists.migrateProfile(p_key):
+                    calendars.touchWishlist(p_key)
+                profile.conferenceKeysToAttend = []
+                profile.sessionWishlistKeys = []
+
+            self._profileMemo = profile
+
+        if create and not self._profileStored:
+            self._putProfile(profile)
         return profile
 
+    def _putProfile(self, profile):
+        """Write profile, keeping the request memo and memcache current."""
+        # ndb invalidates its memcache copy of the entity on put
+        profile.put()
+        self._profileStored = True
+        self._profileMemo = profile
+
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -600,6 +1352,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -607,9 +1360,16 @@ class ConferenceApi(remote.Service):
                         setattr(prof, field, str(val))
             # TODO 4
             # put the modified profile to datastore
-            prof.put()
+            self._putProfile(prof)
+            if prof.displayName != displayName:
+                # cached ConferenceForms carry the organizer's name
+                c_keys = Conference.query(ancestor=prof.key).fetch(
+                    keys_only=True)
+                if c_keys:
+                    cache.bumpVersion(*[c_key.urlsafe() for c_key in c_keys])
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        return self._copyProfileToForm(
+            prof, registrations.conferenceKeysFor(prof.key))
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
@@ -625,67 +1385,88 @@ class ConferenceApi(remote.Service):
 
 # - - - Queries - - - - - - - - - - - - - - - - - - -
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+    def _planQuery(self, request):
+        """Return the query plan for the submitted filters."""
+        return queryplanner.plan(self._formatFilters(request.filters))
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters as
+        (field, operator, value) tuples."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-
             try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
+                field = FIELDS[f.field]
+                operator = OPERATORS[f.operator]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
-            formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+            value = f.value
+            if field in ["month", "maxAttendees"]:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s needs a number." % f.field)
+
+            # inequalities on several fields are fine: the planner applies
+            # all but one of them in memory
+            formatted_filters.append((field, operator, value))
+        return formatted_filters
+
+    def _pageSize(self, request):
+        """Return requested page size, defaulted and capped."""
+        size = request.pageSize or DEFAULT_PAGE_SIZE
+        if size < 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive.")
+        return min(size, MAX_PAGE_SIZE)
+
+    def _fetchPage(self, query, request, **options):
+        """Fetch one page of query results starting at request.cursor.
+
+        Returns (results, nextCursor); nextCursor is None on the last page.
+        Extra options (e.g. keys_only) are passed on to fetch_page.
+        """
+        return self._fetchPageAsync(query, request, **options).get_result()
+
+    @ndb.tasklet
+    def _fetchPageAsync(self, query, request, **options):
+        """Tasklet version of _fetchPage."""
+        try:
+            start = ndb.Cursor(urlsafe=request.cursor) if request.cursor else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid cursor.")
+        results, cursor, more = yield query.fetch_page_async(
+            self._pageSize(request), start_cursor=start, **options)
+        nextCursor = cursor.urlsafe() if more and cursor else None
+        raise ndb.Return((results, nextCursor))
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
+        """Query for conferences, one page at a time; with explain set, also
+        report the query plan and how many conferences it scanned."""
+        plan = self._planQuery(request)
+        try:
+            start = ndb.Cursor(urlsafe=request.cursor) if request.cursor else None
+            conferences, cursor, scanned = queryplanner.fetchPage(
+                plan, self._pageSize(request), start).get_result()
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid cursor.")
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, "") \
-                               for conf in conferences])
+        cf = ConferenceForms(items=serializers.serialize_many(conferences, ConferenceForm),
+                             nextCursor=cursor and cursor.urlsafe())
+        if request.explain:
+            cf.plan = QueryPlanForm(scanned=scanned, **plan.explain())
+        return cf
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_PAGE_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
+    @ndb.synctasklet
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -695,53 +1476,101 @@ class ConferenceApi(remote.Service):
 
         # make profile key
         p_key = ndb.Key(Profile, getUserId(user))
-        # create ancestor query for this user
-        conferences = Conference.query(ancestor=p_key)
-        # get the user profile and display name
-        prof = p_key.get()
-        displayName = getattr(prof, 'displayName')
+        # run ancestor query for this user while getting the user profile
+        got = yield fetchParallel(
+            page=self._fetchPageAsync(Conference.query(ancestor=p_key), request),
+            prof=p_key)
+        conferences, nextCursor = got['page']
+        displayName = getattr(got['prof'], 'displayName', '')
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, displayName) for conf in conferences])
+        raise ndb.Return(ConferenceForms(
+            items=serializers.serialize_many(conferences, ConferenceForm,
+                                             organizerDisplayName=displayName),
+            nextCursor=nextCursor))
+
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @ndb.tasklet
+    def _searchPage(self, kind, request, keep=None):
+        """Return (entities, nextCursor) of one page of ranked search hits.
+
+        The ranking is cached briefly (see textindex), so the cursor is
+        simply the offset of the next page in it.
+        """
+        if not request.q:
+            raise endpoints.BadRequestException("'q' field required")
+        try:
+            offset = int(request.cursor or 0)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise endpoints.BadRequestException("Invalid cursor.")
+
+        ranked = yield textindex.searchAsync(kind, request.q, keep)
+        end = offset + self._pageSize(request)
+        entities = yield ndb.get_multi_async(ranked[offset:end])
+        nextCursor = str(end) if end < len(ranked) else None
+        # skip entities deleted since they were indexed
+        raise ndb.Return(([e for e in entities if e], nextCursor))
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+                      path='searchConferences',
+                      http_method='GET', name='searchConferences')
+    @ndb.synctasklet
+    def searchConferences(self, request):
+        """Search conferences by keywords (or prefixes of them) in their
+        name, topics, city & description, best match first."""
+        conferences, nextCursor = yield self._searchPage('Conference', request)
+        raise ndb.Return(ConferenceForms(
+            items=serializers.serialize_many(conferences, ConferenceForm),
+            nextCursor=nextCursor))
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+                      path='searchSessions',
+                      http_method='GET', name='searchSessions')
+    @ndb.synctasklet
+    def searchSessions(self, request):
+        """Search sessions by keywords (or prefixes of them) in their name,
+        speaker, type & highlights, best match first; optionally only those
+        of conference websafeConferenceKey."""
+        keep = None
+        if request.websafeConferenceKey:
+            c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+            keep = lambda s_key: s_key.parent() == c_key
+        sessions, nextCursor = yield self._searchPage('Session', request, keep)
+        raise ndb.Return(SessionForms(
+            items=serializers.serialize_many(sessions, SessionForm),
+            nextCursor=nextCursor))
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Reconcile the nearly sold out set (kept current by registrations)
+        with the datastore & return its announcement; run by the cron job.
         """
+        # fold sharded seat counters back onto their conferences so the
+        # seatsAvailable query below sees current values
+        Conference.query(Conference.seatShards > 0).map(
+            seats.syncSeatsAvailableAsync)
+
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= announcements.NEARLY_SOLD_OUT_SEATS,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
 
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        return announcements.announcement(announcements.reconcile(confs))
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        # return an existing announcement from Memcache or an empty string.
-        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
-        if not announcement:
-            announcement = ""
+        """Return Announcement of the nearly sold out conferences."""
+        # an empty string if no conference is nearly sold out
+        announcement = announcements.announcement(
+            announcements.nearlySoldOut())
         return StringMessage(data=announcement)
 
-# registers API
-api = endpoints.api_server([ConferenceApi])
+# registers API, accounting each request under 'ConferenceApi.<method>'
+api = requeststats.RequestStats(endpoints.api_server([ConferenceApi]),
+                                prefix='/_ah/spi/')
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""exports.py
+
+CSV exports of a conference's attendees and sessions for its organizer.
+
+An export is a ConferenceExport advanced by chained tasks
+(main.ExportConferenceHandler). Each step reads one cursor-bounded batch
+of one part, 'attendees' then 'sessions', and stores its CSV rows as an
+ExportChunk child of the export, together with the export's new cursor,
+in one transaction that also queues the next step. A step that runs
+again after committing finds the export moved on and does nothing.
+Attendees come from the conference's Registration entities, so no
+Profile scan is involved.
+
+Once done, the organizer is emailed download URLs, which carry the
+export's secret token since they are opened outside the signed in app.
+
+"""
+
+import csv
+import hmac
+import uuid
+from cStringIO import StringIO
+
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from models import ExportChunk
+from models import Session
+
+import registrations
+
+PARTS = ('attendees', 'sessions')
+HEADERS = {
+    'attendees': ['displayName', 'mainEmail', 'teeShirtSize'],
+    'sessions': ['sessionName', 'speaker', 'Date', 'startTime', 'duration',
+                 'typeOfSession', 'highlights'],
+}
+
+
+def newToken():
+    return uuid.uuid4().hex
+
+
+def checkToken(job, token):
+    """Return True if token is the download token of export job."""
+    return bool(job and job.token and token) and \
+        hmac.compare_digest(str(job.token), str(token))
+
+
+def downloadUrl(job, part):
+    """Return the URL of the part CSV of finished export job."""
+    return 'https://%s/exports/%s/%s/%s.csv' % (
+        app_identity.get_default_version_hostname(),
+        job.key.urlsafe(), job.token, part)
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = u';'.join(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def toCsv(rows, header=None):
+    """Return rows (lists of values) as UTF-8 CSV, after header if given."""
+    out = StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow([_cell(value) for value in row])
+    return out.getvalue()
+
+
+def _attendeeRows(c_key, cursor, batchSize):
+    r_keys, cursor, more = registrations.attendeeQuery(c_key).fetch_page(
+        batchSize, start_cursor=cursor, keys_only=True)
+    # each Registration is a child of its registrant's Profile
+    profiles = ndb.get_multi([r_key.parent() for r_key in r_keys])
+    return ([[getattr(prof, field) for field in HEADERS['attendees']]
+             for prof in profiles if prof], cursor, more)
+
+
+def _sessionRows(c_key, cursor, batchSize):
+    sessions, cursor, more = Session.query(ancestor=c_key).fetch_page(
+        batchSize, start_cursor=cursor)
+    return ([[getattr(sess, field) for field in HEADERS['sessions']]
+             for sess in sessions], cursor, more)
+
+_ROWS = {'attendees': _attendeeRows, 'sessions': _sessionRows}
+
+
+def fetchRows(part, c_key, cursor, batchSize):
+    """Return (rows, cursor, more) of the next batch of part of conference
+    c_key, from cursor (websafe, or None to start)."""
+    return _ROWS[part](c_key, cursor and ndb.Cursor(urlsafe=cursor),
+                       batchSize)
+
+
+def totals(c_key):
+    """Return (attendees, sessions) of conference c_key, for progress."""
+    attendees = registrations.attendeeQuery(c_key).count_async()
+    sessions = Session.query(ancestor=c_key).count_async()
+    return attendees.get_result(), sessions.get_result()
+
+
+def chunkKey(j_key, part, step):
+    return ndb.Key(ExportChunk, '%s %06d' % (part, step), parent=j_key)
+
+
+def chunkQuery(j_key, part):
+    """Return a query for the chunks of part of export j_key, in order."""
+    return ExportChunk.query(
+        ExportChunk.key >= ndb.Key(ExportChunk, part + ' ', parent=j_key),
+        ExportChunk.key < ndb.Key(ExportChunk, part + '!', parent=j_key),
+        ancestor=j_key).order(ExportChunk.key)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""imports.py
+
+Parsing for offline conference imports.
+
+An import payload is either a JSON list of objects or a CSV file with a
+header row; keys/columns are ConferenceForm field names. In CSV, repeated
+fields such as topics are separated by semicolons.
+
+"""
+
+import csv
+import json
+from cStringIO import StringIO
+
+from protorpc import messages
+
+from models import ConferenceForm
+
+IMPORT_FORMATS = ('json', 'csv')
+
+
+def parseRows(format, payload):
+    """Return the rows of an import payload as a list of dicts."""
+    if format == 'json':
+        rows = json.loads(payload)
+        if not isinstance(rows, list):
+            raise ValueError('JSON import payload must be a list')
+        return rows
+    if format == 'csv':
+        return list(csv.DictReader(StringIO(payload)))
+    raise ValueError('Unknown import format: %s' % format)
+
+
+def _text(value):
+    """Return value as unicode; CSV cells arrive as UTF-8 bytes."""
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def formFromRow(row):
+    """Return a ConferenceForm built from one import row.
+
+    Raises ValueError if a value does not fit its field.
+    """
+    form = ConferenceForm()
+    for field in form.all_fields():
+        value = row.get(field.name)
+        if value in (None, ''):
+            continue
+        if field.repeated:
+            if isinstance(value, basestring):
+                value = [v.strip() for v in value.split(';') if v.strip()]
+        if isinstance(field, messages.IntegerField):
+            value = [int(v) for v in value] if field.repeated else int(value)
+        elif isinstance(field, messages.StringField):
+            value = [_text(v) for v in value] if field.repeated else _text(value)
+        setattr(form, field.name, value)
+    return form
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""mailer.py
+
+Confirmation emails sent in digests from a pull queue.
+
+Senders queue each email as a pull task tagged with its recipient
+(mailTask/queueMail) instead of a push task that mails at once. The
+mail cron (main.SendMailHandler) leases tasks LEASE_BATCH at a time,
+groups them by recipient and sends each recipient one digest, so a burst
+of conferences created or imported by one organizer becomes one email.
+
+Sending is throttled to MAILS_PER_MINUTE (counted in memcache across
+instances) and stops at the first over quota error; tasks not sent stay
+leased for LEASE_SECS, about until the next run. A task is deleted only
+after its digest went out, so a failed run may at worst repeat a digest.
+
+"""
+
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.runtime import apiproxy_errors
+
+MAIL_QUEUE = 'confirmation-mail'
+LEASE_BATCH = 100
+LEASE_SECS = 60
+MAILS_PER_MINUTE = 60
+MEMCACHE_SENT_KEY = "MAIL SENT %d"
+DIGEST_SEPARATOR = '\r\n\r\n' + '-' * 40 + '\r\n\r\n'
+
+
+def mailTask(email, subject, body):
+    """Return the pull task queueing one email to email."""
+    return taskqueue.Task(
+        payload=json.dumps({'subject': subject, 'body': body}),
+        method='PULL', tag=email)
+
+
+def queueMail(email, subject, body, transactional=False):
+    """Queue one email to email for the next digest."""
+    taskqueue.Queue(MAIL_QUEUE).add(mailTask(email, subject, body),
+                                    transactional=transactional)
+
+
+def digest(messages):
+    """Return (subject, body) of one email combining messages, a list of
+    (subject, body)."""
+    if len(messages) == 1:
+        return messages[0]
+    return ('%d updates from Conference Central' % len(messages),
+            DIGEST_SEPARATOR.join('%s\r\n\r\n%s' % message
+                                  for message in messages))
+
+
+def _takeQuota(n):
+    """Reserve up to n sends from this minute's quota; return how many."""
+    key = MEMCACHE_SENT_KEY % (int(time.time()) // 60)
+    sent = memcache.incr(key, n, initial_value=0)
+    if sent is None:
+        # memcache unavailable: don't let that stop all mail
+        return n
+    return max(0, min(n, MAILS_PER_MINUTE - (sent - n)))
+
+
+def _sender():
+    return 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+
+
+def sendBatch():
+    """Lease a batch of queued emails and send them as digests.
+
+    Returns (emails sent, more) where more is False once the queue ran
+    empty or sending has to wait for quota.
+    """
+    queue = taskqueue.Queue(MAIL_QUEUE)
+    tasks = queue.lease_tasks(LEASE_SECS, LEASE_BATCH)
+    if not tasks:
+        return 0, False
+
+    byRecipient = OrderedDict()
+    for task in tasks:
+        byRecipient.setdefault(task.tag, []).append(task)
+    allowed = _takeQuota(len(byRecipient))
+
+    sent, done, held = 0, [], []
+    for email, group in byRecipient.iteritems():
+        if sent >= allowed:
+            held.extend(group)
+            continue
+        try:
+            messages = [(data['subject'], data['body']) for data in
+                        (json.loads(task.payload) for task in group)]
+        except (ValueError, KeyError):
+            logging.error('Dropping unreadable mail tasks for %s', email)
+            done.extend(group)
+            continue
+        subject, body = digest(messages)
+        try:
+            mail.send_mail(_sender(), email, subject, body)
+        except apiproxy_errors.OverQuotaError:
+            logging.warning('Mail quota exhausted; holding %d emails',
+                            len(tasks) - len(done))
+            allowed = sent
+            held.extend(group)
+            continue
+        except mail.InvalidEmailError:
+            logging.error('Dropping %d emails to invalid address %r',
+                          len(group), email)
+        else:
+            sent += 1
+        done.extend(group)
+
+    if done:
+        queue.delete_tasks(done)
+    return sent, not held and len(tasks) == LEASE_BATCH
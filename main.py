@@ -1,13 +1,34 @@
 #!/usr/bin/env python
+import calendar
+import json
+import time
+from datetime import datetime
 import webapp2
+import endpoints
+from protorpc import messages
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 from conference import ConferenceApi
-from models import SpeakerDict
+from models import Conference
+from models import ConferenceImport
+from models import ExportChunk
+from models import Profile
+from models import Session
+import cache
+import calendars
+import exports
+import imports
+import mailer
+import registrations
+import requeststats
+import speakers
+import textindex
+import wishlists
 import logging
 
-SPEAKER_IDENTIFIER = 1234
-
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
@@ -17,7 +38,10 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation.
+
+        Emails are now queued for digests (see SendMailHandler); this only
+        drains push tasks queued before that."""
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -28,38 +52,511 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
                 'conferenceInfo')
         )
 
+class SendMailHandler(webapp2.RequestHandler):
+    MAX_RUN_SECS = 30
+
+    def get(self):
+        """Send queued emails as per-recipient digests, a leased batch at a
+        time, until the queue is empty or the mail quota is used up."""
+        start = time.time()
+        total, more = 0, True
+        while more and time.time() - start < self.MAX_RUN_SECS:
+            sent, more = mailer.sendBatch()
+            total += sent
+        if total:
+            logging.info('Sent %d digest emails', total)
+
 class AddFeaturedSpeaker(webapp2.RequestHandler):
     def post(self):
-        """Check Speaker being added in Session & add as featured in memcache if qualifies"""
-        speakerName = self.request.get('speakerName')
+        """Count Session for its Speaker & add as featured in memcache if qualifies"""
+        wsck = self.request.get('websafeConferenceKey')
+        wssk = self.request.get('websafeSessionKey')
+        if not wsck or not wssk:
+            # queued before speakers were counted per conference; the
+            # backfill (/tasks/backfill_sessions) counts those sessions
+            logging.warning('Dropping add_featured_speaker task without '
+                            'conference/session keys (speaker %r)',
+                            self.request.get('speakerName'))
+            return
+        speaker = self.request.get('speakerName')
+        if not speakers.normalizeSpeaker(speaker):
+            return
+        c_key = ndb.Key(urlsafe=wsck)
+        s_key = ndb.Key(urlsafe=wssk)
+
+        counter = speakers.countSession(c_key,
+                                        speaker,
+                                        s_key,
+                                        self.request.get('sessionName'))
+        logging.debug('Speaker %r has %d sessions in %s',
+                      counter.speaker, counter.sessionCount, c_key.urlsafe())
+        speakers.cacheFeaturedSpeaker(c_key, counter)
+
+class RebuildAgendaHandler(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the precomputed agenda of a conference."""
+        c_key = ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))
+        ConferenceApi()._storeAgenda(c_key)
+
+class StartConferenceImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Store an uploaded JSON/CSV conference payload & start importing."""
+        format = self.request.get('format', 'json')
+        email = self.request.get('organizerEmail')
+        if format not in imports.IMPORT_FORMATS or not email:
+            self.abort(400, 'organizerEmail and format (json|csv) required')
+
+        payload = self.request.get('payload')
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        job = ConferenceImport(organizerUserId=email,
+                               organizerEmail=email,
+                               format=format,
+                               payload=payload)
+        job.put()
+        taskqueue.add(params={'importKey': job.key.urlsafe()},
+                      url='/tasks/import_conferences')
+        self.response.write(job.key.urlsafe())
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+    IMPORT_CHUNK_SIZE = 200
+    ROW_ERRORS = (ValueError, TypeError, AttributeError,
+                  messages.ValidationError, endpoints.BadRequestException)
+
+    def post(self):
+        """Import the next chunk of a ConferenceImport, then chain the next
+        (or queue the summary email once done)."""
+        job = ndb.Key(urlsafe=self.request.get('importKey')).get()
+        offset = int(self.request.get('offset', 0))
+        if not job or job.done or job.offset != offset:
+            return
+
+        try:
+            rows = imports.parseRows(job.format, job.payload)
+        except ValueError as e:
+            rows = []
+            job.errors.append('Unreadable payload: %s' % e)
+        chunk = rows[offset:offset + self.IMPORT_CHUNK_SIZE]
+        p_key = ndb.Key(Profile, job.organizerUserId)
+        if chunk and job.firstId is None:
+            job.firstId = self._reserveIds(job.key, p_key, len(rows))
+
+        # a run of this chunk that failed before committing may have
+        # created some of its conferences already; keep those as they are
+        c_keys = [ndb.Key(Conference, job.firstId + index, parent=p_key)
+                  for index in range(offset, offset + len(chunk))]
+        existing = ndb.get_multi(c_keys)
+
+        # reuse the API's defaults & date normalization for every row
+        api = ConferenceApi()
+        datas = []
+        c_ids = []
+        for (index, row), c_key, conf in zip(enumerate(chunk, offset),
+                                             c_keys, existing):
+            if conf:
+                job.importedNames.append(conf.name)
+                continue
+            try:
+                form = imports.formFromRow(row)
+                datas.append(api._conferenceData(form, job.organizerUserId))
+                c_ids.append(c_key.id())
+            except self.ROW_ERRORS as e:
+                job.errors.append('#%d: %s' % (index, e))
+        if datas:
+            confs = api._putConferences(p_key, datas, c_ids).get_result()
+            job.importedNames.extend(conf.name for conf in confs)
+
+        job.offset = offset + len(chunk)
+        job.done = job.offset >= len(rows)
+
+        @ndb.transactional
+        def commit():
+            # a concurrent run of this chunk may have committed already
+            if job.key.get().offset != offset:
+                return
+            job.put()
+            if job.done:
+                ConferenceApi._queueImportSummary(
+                    job.organizerEmail, job.importedNames, job.errors,
+                    transactional=True)
+            else:
+                taskqueue.add(params={'importKey': job.key.urlsafe(),
+                                      'offset': job.offset},
+                              url='/tasks/import_conferences',
+                              transactional=True)
+        commit()
+
+    @staticmethod
+    def _reserveIds(j_key, p_key, size):
+        """Reserve size Conference IDs under p_key for import j_key, once;
+        return the first."""
+        first, _ = Conference.allocate_ids(size=size, parent=p_key)
+
+        @ndb.transactional
+        def reserve():
+            job = j_key.get()
+            if job.firstId is None:
+                job.firstId = first
+                job.put()
+            return job.firstId
+        return reserve()
+
+class MigrateProfilesHandler(webapp2.RequestHandler):
+    MIGRATE_BATCH_SIZE = 100
+
+    def get(self):
+        """Start moving legacy Profile registration & wishlist lists onto
+        Registration and WishlistEntry entities."""
+        taskqueue.add(url='/tasks/migrate_profiles')
+
+    def post(self):
+        """Migrate one batch of Profiles, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        p_keys, next_cursor, more = Profile.query().fetch_page(
+            self.MIGRATE_BATCH_SIZE, start_cursor=start, keys_only=True)
+
+        migrated = sum(registrations.migrateProfile(p_key) for p_key in p_keys)
+        wishlisted = 0
+        for p_key in p_keys:
+            moved = wishlists.migrateProfile(p_key)
+            if moved:
+                calendars.touchWishlist(p_key)
+            wishlisted += moved
+        logging.info('Migrated %d registrations & %d wishlist entries '
+                     'from %d profiles', migrated, wishlisted, len(p_keys))
+
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/migrate_profiles')
+
+class ReindexSearchHandler(webapp2.RequestHandler):
+    REINDEX_BATCH_SIZE = 100
+    KINDS = [Conference, Session]
+
+    def get(self):
+        """Start rebuilding the search index of all Conferences & Sessions."""
+        taskqueue.add(url='/tasks/reindex_search')
+
+    def post(self):
+        """Reindex one batch of one kind, then chain the next batch."""
+        kind = int(self.request.get('kind', 0))
+        cursor = self.request.get('cursor')
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        entities, next_cursor, more = self.KINDS[kind].query().fetch_page(
+            self.REINDEX_BATCH_SIZE, start_cursor=start)
+        textindex.reindexAsync(entities).get_result()
+
+        if more and next_cursor:
+            taskqueue.add(params={'kind': kind, 'cursor': next_cursor.urlsafe()},
+                          url='/tasks/reindex_search')
+        elif kind + 1 < len(self.KINDS):
+            taskqueue.add(params={'kind': kind + 1},
+                          url='/tasks/reindex_search')
+
+class BackfillSessionsHandler(webapp2.RequestHandler):
+    BACKFILL_BATCH_SIZE = 200
+    # computed properties, which can't be copied to a new Session
+    COMPUTED = ['startMinute', 'startHour']
+
+    def get(self):
+        """Start bringing existing Sessions up to date: move legacy ones
+        under their Conference, add them to their Speaker entities & store
+        their computed time properties."""
+        taskqueue.add(url='/tasks/backfill_sessions')
+
+    def post(self):
+        """Backfill one batch of Sessions, then chain the next."""
+        cursor = self.request.get('cursor')
+        start = ndb.Cursor(urlsafe=cursor) if cursor else None
+        sessions, next_cursor, more = Session.query().fetch_page(
+            self.BACKFILL_BATCH_SIZE, start_cursor=start)
+
+        moved = set()
+        for index, sess in enumerate(sessions):
+            parent = sess.key.parent()
+            if parent and parent.string_id():
+                sessions[index] = self._rekey(sess)
+                if sessions[index]:
+                    moved.add(sessions[index].key.parent())
+        sessions = [sess for sess in sessions if sess]
+
+        # every step is idempotent, so a retried batch does no harm
+        futures = speakers.addSessionsBySpeakerAsync(sessions)
+        futures.extend(ndb.put_multi_async(sessions))
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        if moved:
+            cache.bumpVersion(*[c_key.urlsafe() for c_key in moved])
+            for c_key in moved:
+                ConferenceApi()._storeAgenda(c_key)
+
+        if more and next_cursor:
+            taskqueue.add(params={'cursor': next_cursor.urlsafe()},
+                          url='/tasks/backfill_sessions')
+
+    def _rekey(self, sess):
+        """Move a legacy Session, keyed under ndb.Key(Conference, <websafe
+        conference key>), under the real Conference key; return the moved
+        Session, or None if its conference is gone.
+
+        The new key is derived from the old one, so a retry finishes the
+        same move. References are rewritten before the old Session is
+        deleted.
+        """
+        old = sess.key
+        try:
+            c_key = ndb.Key(urlsafe=old.parent().string_id())
+        except (TypeError, ProtocolBufferDecodeError):
+            c_key = None
+        if not c_key or c_key.kind() != 'Conference' or not c_key.get():
+            logging.warning('Legacy session %s has no conference; left as is',
+                            old.urlsafe())
+            return None
+        new = ndb.Key(Session, 'legacy-%s' % old.id(), parent=c_key)
+        moving = Session(key=new, **sess.to_dict(exclude=self.COMPUTED))
+        moving.put()
+        textindex.unindexAsync([old]).get_result()
+        textindex.indexAsync([moving]).get_result()
+        if speakers.normalizeSpeaker(sess.speaker):
+            speakers.replaceSession(sess.speaker, old, new)
+            counter = speakers.recountSession(c_key, sess.speaker, old, new,
+                                              sess.sessionName)
+            speakers.cacheFeaturedSpeaker(c_key, counter)
+        for p_key in wishlists.profilesWithSession(old):
+            wishlists.replaceSession(p_key, old, new)
+            calendars.touchWishlist(p_key)
+        old.delete()
+        return moving
+
+class RequestStatsHandler(webapp2.RequestHandler):
+    MAX_HOURS = 24
+
+    def get(self):
+        """Return latency percentiles & RPC counts per endpoint/handler
+        over the last ?hours= hours (default 1) as JSON."""
+        try:
+            hours = min(max(int(self.request.get('hours', 1)), 1),
+                        self.MAX_HOURS)
+        except ValueError:
+            self.abort(400, 'hours must be a number')
+        names = ['ConferenceApi.%s' % name
+                 for name in ConferenceApi.all_remote_methods()]
+        names.extend(path for path, handler in ROUTES)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(
+            {'hours': hours, 'stats': requeststats.summary(names, hours)},
+            indent=2, sort_keys=True))
+
+class ExportConferenceHandler(webapp2.RequestHandler):
+    EXPORT_BATCH_SIZE = 500
+
+    def post(self):
+        """Export the next batch of a ConferenceExport, then chain the next
+        step (or email the organizer once done)."""
+        job = ndb.Key(urlsafe=self.request.get('exportKey')).get()
+        step = int(self.request.get('step', 0))
+        if not job or job.done or job.step != step:
+            return
+        c_key = job.conference
+        if job.attendeesTotal is None:
+            job.attendeesTotal, job.sessionsTotal = exports.totals(c_key)
+
+        rows, next_cursor, more = exports.fetchRows(
+            job.part, c_key, job.cursor, self.EXPORT_BATCH_SIZE)
+        chunk = ExportChunk(
+            key=exports.chunkKey(job.key, job.part, step),
+            data=exports.toCsv(rows, None if job.cursor
+                               else exports.HEADERS[job.part]))
+        exported = job.part + 'Exported'
+        setattr(job, exported, getattr(job, exported) + len(rows))
+        job.step += 1
+        if more and next_cursor:
+            job.cursor = next_cursor.urlsafe()
+        else:
+            job.cursor = None
+            index = exports.PARTS.index(job.part) + 1
+            job.done = index == len(exports.PARTS)
+            if not job.done:
+                job.part = exports.PARTS[index]
+        conf = c_key.get() if job.done else None
+
+        @ndb.transactional
+        def commit():
+            # a concurrent run of this step may have committed already
+            if job.key.get().step != step:
+                return
+            ndb.put_multi([chunk, job])
+            if job.done:
+                mailer.queueMail(
+                    job.organizerEmail,
+                    'Your export of %s is ready' % conf.name,
+                    'Hi, the attendees (%d) & sessions (%d) of %s are ready '
+                    'to download:\r\n\r\n%s' % (
+                        job.attendeesExported, job.sessionsExported,
+                        conf.name, '\r\n'.join(exports.downloadUrl(job, part)
+                                                for part in exports.PARTS)),
+                    transactional=True)
+            else:
+                taskqueue.add(params={'exportKey': job.key.urlsafe(),
+                                      'step': job.step},
+                              url='/tasks/export_conference',
+                              transactional=True)
+        commit()
 
-        dictSpeaker = SpeakerDict.query(SpeakerDict.identifier == SPEAKER_IDENTIFIER).get()
+class DownloadExportHandler(webapp2.RequestHandler):
+    PAGE_SIZE = 20
 
-        # no dictionary exists, create one and initialize
-        if dictSpeaker is None:
-            dictSpeaker = SpeakerDict()
-            dictSpeaker.identifier = SPEAKER_IDENTIFIER
-            dictSpeaker.put()
+    def dispatch(self):
+        # account downloads under the route, not per export
+        self.request.environ[requeststats.NAME_KEY] = self.request.route.template
+        super(DownloadExportHandler, self).dispatch()
 
-        logging.error('BEFORE dictSpeaker is= %s' % dictSpeaker)
+    def get(self, wsek, token, part):
+        """Return one part of a finished export as CSV, a page of chunks
+        at a time; the URL carries the export's token."""
+        try:
+            j_key = ndb.Key(urlsafe=wsek)
+        except (TypeError, ProtocolBufferDecodeError):
+            self.abort(404)
+        job = j_key.get() if j_key.kind() == 'ConferenceExport' else None
+        if part not in exports.PARTS or not exports.checkToken(job, token) \
+                or not job.done:
+            self.abort(404)
+        self.response.content_type = 'text/csv'
+        self.response.charset = 'utf-8'
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename="%s.csv"' % part
+        query = exports.chunkQuery(j_key, part)
+        chunks, cursor, more = query.fetch_page(self.PAGE_SIZE)
+        while True:
+            for chunk in chunks:
+                self.response.write(chunk.data)
+            if not (more and cursor):
+                break
+            chunks, cursor, more = query.fetch_page(self.PAGE_SIZE,
+                                                    start_cursor=cursor)
 
-        # no dict. entry exists for speaker, initialize to 1
-        if dictSpeaker.speaker_num.get(speakerName) == None:
-            dictSpeaker.speaker_num[speakerName] = 1
-        # increment existing speaker entry by 1 and update memcache w/ new speaker
+class CalendarHandler(webapp2.RequestHandler):
+    """Base of the iCalendar feeds: conditional GETs & paged output."""
+    PAGE_SIZE = 100
+    CACHE_CONTROL = 'public, max-age=300'
+
+    def dispatch(self):
+        # account every feed under its route, not per key
+        self.request.environ[requeststats.NAME_KEY] = self.request.route.template
+        super(CalendarHandler, self).dispatch()
+
+    def _key(self, urlsafe, kind):
+        """Return the key urlsafe of the given kind, or abort with a 404."""
+        try:
+            key = ndb.Key(urlsafe=urlsafe)
+        except (TypeError, ProtocolBufferDecodeError):
+            key = None
+        if not key or key.kind() != kind.__name__:
+            self.abort(404)
+        return key
+
+    def _notModified(self, feed, version):
+        """Set the validators of feed at version; if the client's copy is
+        current, answer 304 and return True."""
+        etag, modified = calendars.validators(feed, version)
+        self.response.etag = etag
+        self.response.last_modified = modified
+        self.response.cache_control = self.CACHE_CONTROL
+        self._modified = datetime.utcfromtimestamp(modified)
+        if self.request.if_none_match:
+            fresh = etag in self.request.if_none_match
         else:
-            dictSpeaker.speaker_num[speakerName] += 1
-            api = ConferenceApi()
-            api.cacheFeaturedSpeaker(speakerName)
+            since = self.request.if_modified_since
+            fresh = since is not None and \
+                modified <= calendar.timegm(since.utctimetuple())
+        if fresh:
+            self.response.status = 304
+        return fresh
+
+    def _pages(self, query, **options):
+        """Yield the results of query a page at a time, fetching the next
+        page while the current one is written."""
+        future = query.fetch_page_async(self.PAGE_SIZE, **options)
+        while future:
+            results, cursor, more = future.get_result()
+            future = more and cursor and query.fetch_page_async(
+                self.PAGE_SIZE, start_cursor=cursor, **options)
+            yield results
 
-        logging.error('After dictSpeaker is= %s' % dictSpeaker)
-        dictSpeaker.put()
+    def _writeFeed(self, name, pages):
+        """Write the calendar name of the (sessions, {c_key: conf}) pages,
+        one page at a time."""
+        self.response.content_type = 'text/calendar'
+        self.response.charset = 'utf-8'
+        domain = app_identity.get_default_version_hostname()
+        self.response.write(calendars.header(name, domain))
+        for sessions, confs in pages:
+            self.response.write(''.join(
+                calendars.event(sess, confs.get(sess.key.parent()),
+                                self._modified, domain)
+                for sess in sessions if sess))
+        self.response.write(calendars.footer())
 
+class ConferenceCalendarHandler(CalendarHandler):
+    def get(self, wsck):
+        """Return the sessions of a conference as an iCalendar feed."""
+        c_key = self._key(wsck, Conference)
+        if self._notModified('CONF %s' % wsck, cache.version(wsck)):
+            return
+        conf = c_key.get()
+        if not conf:
+            self.abort(404)
+        confs = {c_key: conf}
+        self._writeFeed(conf.name, (
+            (sessions, confs) for sessions in
+            self._pages(Session.query(ancestor=c_key))))
 
+class WishlistCalendarHandler(CalendarHandler):
+    CACHE_CONTROL = 'private, max-age=300'
 
+    def get(self, wspk, token):
+        """Return a user's wishlisted sessions as an iCalendar feed; the
+        URL (see ConferenceApi.getWishlistCalendarUrl) carries a token in
+        place of a sign in."""
+        p_key = self._key(wspk, Profile)
+        prof = p_key.get()
+        if not calendars.checkToken(prof, token):
+            self.abort(404)
+        if self._notModified(calendars.wishlistVersionId(p_key),
+                             calendars.wishlistVersion(p_key)):
+            return
+        self._writeFeed('Wishlist', self._wishlistPages(p_key))
 
-app = webapp2.WSGIApplication([
+    def _wishlistPages(self, p_key):
+        for e_keys in self._pages(wishlists.wishlistQuery(p_key),
+                                  keys_only=True):
+            # each id is a websafe session key
+            s_keys = [ndb.Key(urlsafe=e_key.id()) for e_key in e_keys]
+            c_keys = list(set(s_key.parent() for s_key in s_keys))
+            entities = ndb.get_multi(s_keys + c_keys)
+            yield (entities[:len(s_keys)],
+                   dict(zip(c_keys, entities[len(s_keys):])))
+
+
+ROUTES = [
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/crons/send_mail', SendMailHandler),
     ('/tasks/add_featured_speaker', AddFeaturedSpeaker),
-], debug=True)
+    ('/tasks/rebuild_agenda', RebuildAgendaHandler),
+    ('/tasks/migrate_profiles', MigrateProfilesHandler),
+    ('/admin/import_conferences', StartConferenceImportHandler),
+    ('/tasks/import_conferences', ImportConferencesHandler),
+    ('/tasks/reindex_search', ReindexSearchHandler),
+    ('/tasks/backfill_sessions', BackfillSessionsHandler),
+    ('/admin/stats', RequestStatsHandler),
+    ('/tasks/export_conference', ExportConferenceHandler),
+    (r'/exports/([^/]+)/([^/]+)/([a-z]+)\.csv', DownloadExportHandler),
+    (r'/calendars/conference/([^/]+)\.ics', ConferenceCalendarHandler),
+    (r'/calendars/wishlist/([^/]+)/([^/]+)\.ics', WishlistCalendarHandler),
+]
+
+app = requeststats.RequestStats(webapp2.WSGIApplication(ROUTES, debug=True))
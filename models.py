@@ -39,6 +39,12 @@ class Session(ndb.Model):
     typeOfSession = ndb.StringProperty(repeated=True)
     Date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
+    # precomputed so time windows can be matched by equality/IN
+    startMinute = ndb.ComputedProperty(
+        lambda self: None if self.startTime is None else
+        self.startTime.hour * 60 + self.startTime.minute)
+    startHour = ndb.ComputedProperty(
+        lambda self: None if self.startTime is None else self.startTime.hour)
 
 class SessionForm(messages.Message):
     confwebsafeKey = messages.StringField(1)
@@ -50,22 +56,129 @@ class SessionForm(messages.Message):
     Date = messages.StringField(7)
     startTime = messages.StringField(8)    
 
+class QueryPlanForm(messages.Message):
+    """QueryPlanForm -- how queryConferences ran a query (explain)"""
+    strategy = messages.StringField(1)
+    datastoreFilters = messages.StringField(2, repeated=True)
+    memoryFilters = messages.StringField(3, repeated=True)
+    order = messages.StringField(4)
+    estimatedSelectivity = messages.FloatField(5)
+    scanned = messages.IntegerField(6)
+
 class SessionForms(messages.Message):
     """SessionForms -- multiple Sessions outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    plan = messages.MessageField(QueryPlanForm, 3)
+
+class TimeWindowForm(messages.Message):
+    """TimeWindowForm -- start times from start (HH:MM) up to end; a window
+    ending before it starts runs past midnight"""
+    start = messages.StringField(1, required=True)
+    end = messages.StringField(2, required=True)
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session search inbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    windows = messages.MessageField(TimeWindowForm, 2, repeated=True)
+    maxDuration = messages.IntegerField(3)
+    includeTypes = messages.StringField(4, repeated=True)
+    excludeTypes = messages.StringField(5, repeated=True)
+    pageSize = messages.IntegerField(6)
+    cursor = messages.StringField(7)
+    explain = messages.BooleanField(8)
+
+class AgendaDayForm(messages.Message):
+    """AgendaDayForm -- one day of a conference agenda"""
+    date = messages.StringField(1)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- conference agenda outbound form message"""
+    days = messages.MessageField(AgendaDayForm, 1, repeated=True)
+
+class ConferenceAgenda(ndb.Model):
+    """ConferenceAgenda -- precomputed AgendaForm of a Conference, serialized"""
+    agenda = ndb.TextProperty(compressed=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class SessionBatchForm(messages.Message):
+    """SessionBatchForm -- inbound createSessions batch message"""
+    items = messages.MessageField(SessionForm, 1, repeated=True)
+
+class SessionBatchResult(messages.Message):
+    """SessionBatchResult -- outcome of one item of a createSessions batch"""
+    index = messages.IntegerField(1)
+    session = messages.MessageField(SessionForm, 2)
+    error = messages.StringField(3)
 
-class SpeakerDict(ndb.Model):
-    identifier= ndb.IntegerProperty(default = 1234)
-    speaker_num = ndb.PickleProperty(default={})
+class SessionBatchResults(messages.Message):
+    """SessionBatchResults -- outbound createSessions results message"""
+    items = messages.MessageField(SessionBatchResult, 1, repeated=True)
+
+class ConferenceSpeaker(ndb.Model):
+    """ConferenceSpeaker -- sessions counted for one speaker at one
+    Conference; child of the Conference, keyed by the normalized speaker
+    name (see Speaker), with speaker as first written"""
+    speaker = ndb.StringProperty(required=True)
+    sessionCount = ndb.IntegerProperty(default=0)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+
+class Speaker(ndb.Model):
+    """Speaker -- a speaker's sessions across all Conferences; root entity
+    keyed by the normalized (lowercased, single-spaced) speaker name"""
+    name = ndb.StringProperty(indexed=False)
+    sessionCount = ndb.IntegerProperty(default=0)
+    sessionKeys = ndb.KeyProperty(kind='Session', repeated=True, indexed=False)
+
+class SpeakerForm(messages.Message):
+    """SpeakerForm -- Speaker directory entry outbound form message"""
+    name = messages.StringField(1)
+    sessionCount = messages.IntegerField(2)
+
+class SpeakerForms(messages.Message):
+    """SpeakerForms -- a page of the Speaker directory"""
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
+    # read by nearly every request, so ndb's memcache copy (on by default,
+    # invalidated on every put) matters; expire it after an hour rather
+    # than never, as ndb would by default
+    _memcache_timeout = 60 * 60
+
     userId = ndb.StringProperty()
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy; registrations now live in Registration children of the Profile
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # legacy; wishlists now live in WishlistEntry children of the Profile
     sessionWishlistKeys = ndb.StringProperty(repeated=True)
+    # secret in the URL of the user's wishlist calendar feed
+    calendarToken = ndb.StringProperty(indexed=False)
+
+class Registration(ndb.Model):
+    """Registration -- a user's registration for one Conference; child of the
+    registrant's Profile with the websafe conference key as its id"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+
+class SearchPosting(ndb.Model):
+    """SearchPosting -- one term of a Conference or Session in the keyword
+    search index; term is '<Kind> <term>'"""
+    # only ever read by query; skip ndb's per-key cache bookkeeping
+    _use_cache = False
+    _use_memcache = False
+    term = ndb.StringProperty(required=True)
+    doc = ndb.KeyProperty(required=True)
+    weight = ndb.FloatProperty(indexed=False)
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- a Session on a user's wishlist; child of the user's
+    Profile with the websafe session key as its id"""
+    session = ndb.KeyProperty(kind='Session', required=True)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -82,6 +195,11 @@ class ProfileForm(messages.Message):
     conferenceKeysToAttend = messages.StringField(5, repeated=True)
     sessionWishlistIDs = messages.StringField(6, repeated=True)
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
     NOT_SPECIFIED = 1
@@ -112,6 +230,17 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- a Conference in the nearly sold out announcement;
+    root entity keyed by websafe conference key"""
+    name            = ndb.StringProperty(indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a sharded Conference seat counter"""
+    capacity        = ndb.IntegerProperty(default=0, indexed=False)
+    seatsTaken      = ndb.IntegerProperty(default=0, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -127,10 +256,115 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10)
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    expectedDemand  = messages.IntegerField(13)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    plan = messages.MessageField(QueryPlanForm, 3)
+
+class SeatsForm(messages.Message):
+    """SeatsForm -- live seats available of one Conference"""
+    websafeConferenceKey = messages.StringField(1)
+    seatsAvailable = messages.IntegerField(2)
+
+class SeatsForms(messages.Message):
+    """SeatsForms -- live seats available of several Conferences"""
+    items = messages.MessageField(SeatsForm, 1, repeated=True)
+
+class ConferenceBatchResult(messages.Message):
+    """ConferenceBatchResult -- outcome of one item of an import batch"""
+    index = messages.IntegerField(1)
+    conference = messages.MessageField(ConferenceForm, 2)
+    error = messages.StringField(3)
+
+class ConferenceBatchResults(messages.Message):
+    """ConferenceBatchResults -- outbound importConferences results message"""
+    items = messages.MessageField(ConferenceBatchResult, 1, repeated=True)
+
+class ConferenceImport(ndb.Model):
+    """ConferenceImport -- offline conference load, processed by chained tasks"""
+    organizerUserId = ndb.StringProperty(required=True)
+    organizerEmail  = ndb.StringProperty(indexed=False)
+    format          = ndb.StringProperty(choices=('json', 'csv'), indexed=False)
+    payload         = ndb.BlobProperty(compressed=True)
+    offset          = ndb.IntegerProperty(default=0, indexed=False)
+    # row i becomes Conference ID firstId + i, so a retried chunk
+    # finds the conferences it created instead of creating them again
+    firstId         = ndb.IntegerProperty(indexed=False)
+    importedNames   = ndb.StringProperty(repeated=True, indexed=False)
+    errors          = ndb.StringProperty(repeated=True, indexed=False)
+    done            = ndb.BooleanProperty(default=False)
+
+class ConferenceExport(ndb.Model):
+    """ConferenceExport -- CSV export of a Conference's attendees & sessions,
+    written by chained tasks into ExportChunk children"""
+    conference        = ndb.KeyProperty(kind='Conference', required=True)
+    organizerEmail    = ndb.StringProperty(indexed=False)
+    # secret in the download URLs
+    token             = ndb.StringProperty(indexed=False)
+    part              = ndb.StringProperty(default='attendees', indexed=False)
+    cursor            = ndb.StringProperty(indexed=False)
+    step              = ndb.IntegerProperty(default=0, indexed=False)
+    attendeesTotal    = ndb.IntegerProperty(indexed=False)
+    attendeesExported = ndb.IntegerProperty(default=0, indexed=False)
+    sessionsTotal     = ndb.IntegerProperty(indexed=False)
+    sessionsExported  = ndb.IntegerProperty(default=0, indexed=False)
+    done              = ndb.BooleanProperty(default=False)
+    created           = ndb.DateTimeProperty(auto_now_add=True)
+
+class ExportChunk(ndb.Model):
+    """ExportChunk -- CSV rows written by one step of a ConferenceExport
+    (its parent); id '<part> <step>'"""
+    data = ndb.BlobProperty(compressed=True)
+
+class ExportForm(messages.Message):
+    """ExportForm -- progress of a ConferenceExport outbound form message"""
+    websafeExportKey = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    part = messages.StringField(3)
+    attendeesTotal = messages.IntegerField(4)
+    attendeesExported = messages.IntegerField(5)
+    sessionsTotal = messages.IntegerField(6)
+    sessionsExported = messages.IntegerField(7)
+    done = messages.BooleanField(8)
+    attendeesUrl = messages.StringField(9)
+    sessionsUrl = messages.StringField(10)
+
+class WishlistItemForm(messages.Message):
+    """WishlistItemForm -- wishlisted Session with its Conference"""
+    websafeSessionKey = messages.StringField(1)
+    session = messages.MessageField(SessionForm, 2)
+    conference = messages.MessageField(ConferenceForm, 3)
+
+class WishlistForms(messages.Message):
+    """WishlistForms -- one page of a user's wishlist outbound form message"""
+    items = messages.MessageField(WishlistItemForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
+class WishlistAddForm(messages.Message):
+    """WishlistAddForm -- result of adding a Session to the wishlist, with
+    the wishlisted Sessions its time overlaps"""
+    data = messages.BooleanField(1)
+    conflicts = messages.MessageField(SessionForm, 2, repeated=True)
+
+class SessionConflictForm(messages.Message):
+    """SessionConflictForm -- two wishlisted Sessions overlapping in time"""
+    first = messages.MessageField(SessionForm, 1)
+    second = messages.MessageField(SessionForm, 2)
+    overlapMinutes = messages.IntegerField(3)
+
+class ConferenceConflictForm(messages.Message):
+    """ConferenceConflictForm -- two registered Conferences sharing days"""
+    first = messages.MessageField(ConferenceForm, 1)
+    second = messages.MessageField(ConferenceForm, 2)
+    overlapDays = messages.IntegerField(3)
+
+class ScheduleConflictsForm(messages.Message):
+    """ScheduleConflictsForm -- all clashes in a user's schedule"""
+    sessions = messages.MessageField(SessionConflictForm, 1, repeated=True)
+    conferences = messages.MessageField(ConferenceConflictForm, 2, repeated=True)
 
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
@@ -141,6 +375,9 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    cursor = messages.StringField(3)
+    explain = messages.BooleanField(4)
 
 # needed for conference registration
 class BooleanMessage(messages.Message):
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""queryplanner.py
+
+Plans queryConferences filters (and querySessions criteria, see
+SessionPlan) onto the built-in single-property indexes.
+
+The datastore only allows inequalities on one property per query, and
+mixing filters with a sort order needs a composite index for each
+combination. Instead the planner pushes one part of the filters to the
+datastore, picked by estimated selectivity:
+
+    equality  every '=' filter, merge-joined, in key order
+    range     the '<' '<=' '>' '>=' filters on one property, in its order
+    scan      nothing, in name order (used when there are no filters)
+
+and applies the remaining filters in memory while streaming results,
+stopping once a page is full (or MAX_SCAN entities have been read).
+'!=' is always applied in memory: the datastore would run it as two
+queries, which cannot be paged with cursors.
+
+"""
+
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Session
+
+MAX_SCAN = 1000
+
+COMPARE = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+RANGE_OPERATORS = ('<', '<=', '>', '>=')
+REPEATED_FIELDS = ('topics',)
+
+# rough fraction of conferences passing a filter, for choosing a plan
+EQ_SELECTIVITY = {
+    'city': 0.1,
+    'topics': 0.2,
+    'month': 1.0 / 12,
+    'maxAttendees': 0.02,
+}
+RANGE_SELECTIVITY = 1.0 / 3
+BOUNDED_RANGE_SELECTIVITY = 0.25
+FIELD_DOMAINS = {'month': (1, 12)}
+
+
+def _describe(filters):
+    return ['%s %s %s' % f for f in filters]
+
+
+def _rangeSelectivity(field, filters):
+    """Estimate the fraction of conferences within filters on field."""
+    if field in FIELD_DOMAINS:
+        low, high = FIELD_DOMAINS[field]
+        inside = [v for v in range(low, high + 1)
+                  if all(COMPARE[op](v, value) for _, op, value in filters)]
+        return float(len(inside)) / (high - low + 1)
+    ops = set(op[0] for _, op, _ in filters)
+    return BOUNDED_RANGE_SELECTIVITY if len(ops) > 1 else RANGE_SELECTIVITY
+
+
+class Plan(object):
+    """A chosen split of filters into datastore and in-memory parts."""
+
+    def __init__(self, strategy, pushed, residual, order, estimate):
+        self.strategy = strategy
+        self.pushed = pushed
+        self.residual = residual
+        self.order = order
+        self.estimate = estimate
+
+    def query(self):
+        """Return the datastore query this plan runs."""
+        q = Conference.query()
+        for field, op, value in self.pushed:
+            q = q.filter(ndb.query.FilterNode(field, op, value))
+        if self.order == '__key__':
+            return q.order(Conference.key)
+        return q.order(Conference._properties[self.order])
+
+    def matches(self, conf):
+        """Return True if conf passes the in-memory filters."""
+        byField = {}
+        for f in self.residual:
+            byField.setdefault(f[0], []).append(f)
+        for field, filters in byField.iteritems():
+            values = getattr(conf, field)
+            if field not in REPEATED_FIELDS:
+                values = [values]
+            # like the datastore: each equality may match any value, but one
+            # value must satisfy all the inequalities on the property
+            values = [v for v in values if v is not None]
+            for _, op, value in filters:
+                if op == '=' and value not in values:
+                    return False
+            inequalities = [f for f in filters if f[1] != '=']
+            if inequalities and not any(
+                    all(COMPARE[op](v, value) for _, op, value in inequalities)
+                    for v in values):
+                return False
+        return True
+
+    def explain(self):
+        """Return a dict describing the plan."""
+        return {
+            'strategy': self.strategy,
+            'datastoreFilters': _describe(self.pushed),
+            'memoryFilters': _describe(self.residual),
+            'order': self.order,
+            'estimatedSelectivity': self.estimate,
+        }
+
+
+def plan(filters):
+    """Return the Plan for filters, a list of (field, operator, value)."""
+    if not filters:
+        return Plan('scan', [], [], 'name', 1.0)
+
+    candidates = []
+    equalities = [f for f in filters if f[1] == '=']
+    if equalities:
+        estimate = 1.0
+        for field, _, _ in equalities:
+            estimate *= EQ_SELECTIVITY.get(field, 0.1)
+        candidates.append((estimate, 0, Plan(
+            'equality', equalities,
+            [f for f in filters if f[1] != '='], '__key__', estimate)))
+
+    ranged = sorted(set(f[0] for f in filters if f[1] in RANGE_OPERATORS
+                        and f[0] not in REPEATED_FIELDS))
+    for field in ranged:
+        pushed = [f for f in filters
+                  if f[0] == field and f[1] in RANGE_OPERATORS]
+        estimate = _rangeSelectivity(field, pushed)
+        candidates.append((estimate, 1, Plan(
+            'range', pushed, [f for f in filters if f not in pushed],
+            field, estimate)))
+
+    if not candidates:
+        return Plan('scan', [], list(filters), 'name', 1.0)
+    return min(candidates, key=lambda c: c[:2])[2]
+
+
+@ndb.tasklet
+def streamPage(query, matches, pageSize, start_cursor=None):
+    """Stream query from start_cursor, keeping entities that matches().
+
+    Returns (results, cursor, scanned); cursor (an ndb.Cursor) is None when
+    the query is exhausted.
+    """
+    it = query.iter(start_cursor=start_cursor, produce_cursors=True,
+                    batch_size=min(pageSize * 2, MAX_SCAN))
+    results, scanned, cursor = [], 0, None
+    while len(results) < pageSize and scanned < MAX_SCAN:
+        more = yield it.has_next_async()
+        if not more:
+            raise ndb.Return((results, None, scanned))
+        entity = it.next()
+        scanned += 1
+        if matches(entity):
+            results.append(entity)
+        cursor = it.cursor_after()
+    more = yield it.has_next_async()
+    raise ndb.Return((results, cursor if more else None, scanned))
+
+
+def fetchPage(plan, pageSize, start_cursor=None):
+    """Return a Future of streamPage for plan's query and filters."""
+    return streamPage(plan.query(), plan.matches, pageSize, start_cursor)
+
+
+# - - - Sessions - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+# push the hour buckets of the time windows while they are this few;
+# beyond that included session types (if any) are the better filter
+MAX_PUSHED_HOURS = 6
+
+
+def windowHours(windows):
+    """Return the sorted hours (0-23) touched by (start, end) minute-of-day
+    windows; a window with end <= start wraps past midnight."""
+    hours = set()
+    for start, end in windows:
+        if end <= start:
+            end += 24 * 60
+        hours.update(h % 24 for h in range(start // 60, (end - 1) // 60 + 1))
+    return sorted(hours)
+
+
+def inWindows(minute, windows):
+    """Return True if minute of day falls in one of the windows."""
+    for start, end in windows:
+        if start <= minute < end or \
+                (end <= start and (minute >= start or minute < end)):
+            return True
+    return False
+
+
+class SessionPlan(object):
+    """Session search: one property matched by the datastore (equality or
+    IN), the other criteria checked in memory."""
+
+    def __init__(self, c_key=None, windows=(), maxDuration=None,
+                 includeTypes=(), excludeTypes=()):
+        self.c_key = c_key
+        self.windows = list(windows)
+        self.maxDuration = maxDuration
+        self.includeTypes = list(includeTypes)
+        self.excludeTypes = set(excludeTypes)
+        self.hours = windowHours(self.windows)
+        if self.hours and (len(self.hours) <= MAX_PUSHED_HOURS or
+                           not self.includeTypes):
+            self.pushed = 'startHour'
+        elif self.includeTypes:
+            self.pushed = 'typeOfSession'
+        else:
+            self.pushed = None
+
+    def query(self):
+        """Return the datastore query this plan runs."""
+        q = Session.query(ancestor=self.c_key) if self.c_key else Session.query()
+        if self.pushed == 'startHour':
+            q = q.filter(Session.startHour.IN(self.hours))
+        elif self.pushed == 'typeOfSession':
+            q = q.filter(Session.typeOfSession.IN(self.includeTypes))
+        # key order lets IN's merged queries be paged with cursors
+        return q.order(Session.key)
+
+    def matches(self, sess):
+        """Return True if sess passes the in-memory criteria."""
+        if self.windows and (sess.startMinute is None or
+                             not inWindows(sess.startMinute, self.windows)):
+            return False
+        if self.maxDuration is not None and \
+                (sess.duration is None or sess.duration > self.maxDuration):
+            return False
+        types = set(sess.typeOfSession)
+        if self.includeTypes and not types.intersection(self.includeTypes):
+            return False
+        return not types.intersection(self.excludeTypes)
+
+    def explain(self):
+        """Return a dict describing the plan."""
+        pushed = {'startHour': 'startHour IN %s' % self.hours,
+                  'typeOfSession': 'typeOfSession IN %s' % self.includeTypes}
+        memory = []
+        if self.windows:
+            memory.append('startMinute in %s' % self.windows)
+        if self.maxDuration is not None:
+            memory.append('duration <= %d' % self.maxDuration)
+        if self.includeTypes and self.pushed != 'typeOfSession':
+            memory.append('typeOfSession in %s' % self.includeTypes)
+        if self.excludeTypes:
+            memory.append('typeOfSession not in %s' % sorted(self.excludeTypes))
+        return {
+            'strategy': 'equality' if self.pushed else 'scan',
+            'datastoreFilters': [pushed[self.pushed]] if self.pushed else [],
+            'memoryFilters': memory,
+            'order': '__key__',
+        }
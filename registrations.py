@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""registrations.py
+
+Conference registrations stored as Registration entities.
+
+A Registration is a child of the registrant's Profile whose id is the
+websafe conference key, so checking a registration is one key lookup and
+listing a user's conferences is a keys-only ancestor query. Attendees of a
+conference are found with a keys-only query on Registration.conference.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Registration
+
+
+def registrationKey(p_key, wsck):
+    """Return the Registration key of profile p_key for conference wsck."""
+    return ndb.Key(Registration, wsck, parent=p_key)
+
+
+def conferenceQuery(p_key):
+    """Return a keys-only-friendly query for the registrations of p_key."""
+    return Registration.query(ancestor=p_key)
+
+
+def attendeeQuery(c_key):
+    """Return a keys-only-friendly query for the registrations of c_key."""
+    return Registration.query(Registration.conference == c_key)
+
+
+def conferenceKeysFor(p_key):
+    """Return websafe keys of all conferences profile p_key attends."""
+    return [r_key.id() for r_key in
+            conferenceQuery(p_key).fetch(keys_only=True)]
+
+
+@ndb.transactional
+def migrateProfile(p_key):
+    """Move a Profile's legacy conferenceKeysToAttend list into
+    Registration entities. Returns the number of registrations written."""
+    prof = p_key.get()
+    if not prof or not prof.conferenceKeysToAttend:
+        return 0
+    regs = [Registration(key=registrationKey(p_key, wsck),
+                         conference=ndb.Key(urlsafe=wsck))
+            for wsck in set(prof.conferenceKeysToAttend)]
+    prof.conferenceKeysToAttend = []
+    ndb.put_multi(regs + [prof])
+    return len(regs)
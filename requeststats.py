@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""requeststats.py
+
+Per-request RPC accounting, slow-request logging and aggregated stats.
+
+RequestStats wraps a WSGI app (the endpoints SPI server, main.app) and,
+through an API post-call hook, counts for each request the datastore
+gets, puts and queries, memcache hits and misses and tasks enqueued.
+Requests slower than SLOW_REQUEST_MS are logged as one JSON line.
+
+Every request also lands in a latency histogram and counter totals per
+request name and hourly window. Instances batch these in memory and add
+them to memcache (one offset_multi) at most every STATS_FLUSH_SECS, so
+stats are best effort: memcache may evict them and an instance going
+away drops its last few seconds.
+
+"""
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+SLOW_REQUEST_MS = 1000
+STATS_FLUSH_SECS = 10
+STATS_WINDOW_SECS = 60 * 60
+MEMCACHE_STATS_KEY = "STATS %d %s %s"
+# upper bounds (ms) of the latency histogram buckets; the last is open
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+NAME_KEY = 'requeststats.name'
+COUNTERS = ('ds_get', 'ds_put', 'ds_query', 'mc_hit', 'mc_miss', 'tasks')
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending = {}
+_lastFlush = [time.time()]
+
+
+def _countRpc(service, call, request, response):
+    """API post-call hook: add the RPC to the current request's counters."""
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service == 'datastore_v3':
+        if call == 'Get':
+            counts['ds_get'] += 1
+        elif call == 'Put':
+            counts['ds_put'] += 1
+        elif call in ('RunQuery', 'Next'):
+            counts['ds_query'] += 1
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counts['mc_hit'] += hits
+        counts['mc_miss'] += request.key_size() - hits
+    elif service == 'taskqueue' and call == 'BulkAdd':
+        counts['tasks'] += request.add_request_size()
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'requeststats', _countRpc)
+
+
+def _bucket(ms):
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _window(now=None):
+    return int(now or time.time()) // STATS_WINDOW_SECS
+
+
+def _statsKey(window, name, counter):
+    return MEMCACHE_STATS_KEY % (window, name, counter)
+
+
+def _record(name, ms, counts, error):
+    """Add a finished request to the pending totals; flush when due."""
+    window = _window()
+    deltas = dict(counts)
+    deltas.update({'count': 1, 'ms': int(ms), 'b%d' % _bucket(ms): 1,
+                   'slow': int(ms > SLOW_REQUEST_MS), 'errors': int(error)})
+    with _lock:
+        for counter, delta in deltas.iteritems():
+            if delta:
+                key = _statsKey(window, name, counter)
+                _pending[key] = _pending.get(key, 0) + delta
+        if time.time() - _lastFlush[0] < STATS_FLUSH_SECS:
+            return
+        flush = _pending.copy()
+        _pending.clear()
+        _lastFlush[0] = time.time()
+    try:
+        memcache.offset_multi(flush, initial_value=0)
+    except Exception:
+        logging.warning('Could not flush request stats', exc_info=True)
+
+
+class RequestStats(object):
+    """WSGI middleware accounting each request of app under a name.
+
+    The name is the request path with prefix stripped, so for the
+    endpoints SPI server (prefix '/_ah/spi/') it is e.g.
+    'ConferenceApi.getConference'.
+
+    A handler whose paths vary (e.g. carry an entity key) can name the
+    request instead by setting environ[NAME_KEY], such as to its route.
+    """
+
+    def __init__(self, app, prefix=''):
+        self.app = app
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        name = environ.get('PATH_INFO', '')
+        if self.prefix and name.startswith(self.prefix):
+            name = name[len(self.prefix):]
+        status = []
+
+        def startResponse(s, headers, exc_info=None):
+            status.append(s)
+            return start_response(s, headers, exc_info)
+
+        _local.counts = dict.fromkeys(COUNTERS, 0)
+        start = time.time()
+        try:
+            return self.app(environ, startResponse)
+        except Exception:
+            status.append('500')
+            raise
+        finally:
+            ms = (time.time() - start) * 1000
+            counts, _local.counts = _local.counts, None
+            name = environ.get(NAME_KEY, name)
+            error = bool(status) and status[-1][:1] == '5'
+            if ms > SLOW_REQUEST_MS:
+                entry = dict(counts, request=name, ms=int(ms),
+                             status=status[-1] if status else None)
+                logging.warning('Slow request: %s',
+                                json.dumps(entry, sort_keys=True))
+            _record(name, ms, counts, error)
+
+
+def _percentile(buckets, count, p):
+    """Return the upper bound (ms) of the bucket holding percentile p."""
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= p * count:
+            break
+    return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+
+
+def summary(names, hours=1):
+    """Return aggregated stats of the given request names over the last
+    hours windows, as a dict of name -> stats (names never seen omitted).
+
+    Percentiles are bucket upper bounds in ms; None means above the
+    largest bucket.
+    """
+    now = _window()
+    windows = range(now - hours + 1, now + 1)
+    fields = ['count', 'ms', 'slow', 'errors'] + list(COUNTERS) + \
+        ['b%d' % i for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+    keys = [_statsKey(w, name, field)
+            for name in names for w in windows for field in fields]
+    got = memcache.get_multi(keys)
+
+    stats = {}
+    for name in names:
+        totals = dict((field, sum(int(got.get(_statsKey(w, name, field), 0))
+                                  for w in windows))
+                      for field in fields)
+        count = totals['count']
+        if not count:
+            continue
+        buckets = [totals['b%d' % i]
+                   for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+        entry = {
+            'requests': count,
+            'slow': totals['slow'],
+            'errors': totals['errors'],
+            'mean_ms': float(totals['ms']) / count,
+            'p50_ms': _percentile(buckets, count, 0.5),
+            'p90_ms': _percentile(buckets, count, 0.9),
+            'p99_ms': _percentile(buckets, count, 0.99),
+        }
+        for counter in COUNTERS:
+            entry[counter + '_per_request'] = float(totals[counter]) / count
+        stats[name] = entry
+    return stats
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""schedule.py
+
+Schedule conflicts between wishlisted sessions (or registered conferences).
+
+Items are turned into [start, end) datetime intervals and sorted by start.
+All overlapping pairs are then found in one sweep that keeps the intervals
+still running in a heap ordered by end, so a schedule of n items with k
+clashes costs O(n log n + k) rather than comparing every pair. Items
+without a full schedule (date, start time, duration) never conflict.
+
+"""
+
+import heapq
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+
+def sessionInterval(sess):
+    """Return the [start, end) datetimes of Session sess, or None."""
+    if sess.Date is None or sess.startTime is None or not sess.duration:
+        return None
+    start = datetime.combine(sess.Date, sess.startTime)
+    return start, start + timedelta(minutes=sess.duration)
+
+
+def conferenceInterval(conf):
+    """Return the [start, end) datetimes of Conference conf (whole days),
+    or None."""
+    if conf.startDate is None:
+        return None
+    end = conf.endDate or conf.startDate
+    return (datetime.combine(conf.startDate, datetime.min.time()),
+            datetime.combine(end, datetime.min.time()) + timedelta(days=1))
+
+
+def _sortedIntervals(items, interval):
+    spans = []
+    for item in items:
+        span = interval(item)
+        if span:
+            spans.append((span[0], span[1], item))
+    spans.sort(key=lambda span: span[:2])
+    return spans
+
+
+def overlappingPairs(items, interval):
+    """Return (first, second, overlap timedelta) for every pair of items
+    whose intervals overlap; first starts no later than second."""
+    pairs = []
+    running = []   # heap of (end, index, start, item) of started intervals
+    for index, (start, end, item) in enumerate(_sortedIntervals(items, interval)):
+        while running and running[0][0] <= start:
+            heapq.heappop(running)
+        for otherEnd, _, otherStart, other in running:
+            pairs.append((other, item, min(end, otherEnd) - start))
+        heapq.heappush(running, (end, index, start, item))
+    return pairs
+
+
+def conflictsWith(item, items, interval):
+    """Return the items whose intervals overlap item's."""
+    span = interval(item)
+    if not span:
+        return []
+    spans = _sortedIntervals(items, interval)
+    # only items starting before item ends can overlap it
+    last = bisect_left([s[0] for s in spans], span[1])
+    return [other for start, end, other in spans[:last]
+            if end > span[0] and other is not item]
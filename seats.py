@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counters for high-demand conferences.
+
+A sharded Conference keeps its seats in SeatShard root entities (each its
+own entity group) so concurrent registrations do not all contend on the
+Conference entity. Each shard owns a fixed slice of maxAttendees, so the
+total can never be oversold; a registration only fails once every shard
+is full.
+
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+MAX_SEAT_SHARDS = 20
+MEMCACHE_SEATS_KEY = "SEATS AVAILABLE %s"
+SEATS_CACHE_TTL = 30
+
+
+class ShardUnavailable(Exception):
+    """Raised inside a registration transaction when the chosen shard has
+    no seat to give (registration) or take back (unregistration)."""
+
+
+def shardCount(expectedDemand, maxAttendees):
+    """Return number of seat shards for expected peak registrations/second.
+
+    An entity group sustains roughly one write per second, so demand of one
+    or less keeps the plain (unsharded) Conference.seatsAvailable counter.
+    """
+    if not expectedDemand or expectedDemand <= 1 or maxAttendees <= 0:
+        return 0
+    return min(expectedDemand, MAX_SEAT_SHARDS, maxAttendees)
+
+
+def shardKeys(conf):
+    """Return the SeatShard keys of a sharded conference."""
+    wsck = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i))
+            for i in range(conf.seatShards)]
+
+
+def makeShards(conf):
+    """Return new SeatShard entities splitting conf.maxAttendees evenly."""
+    base, extra = divmod(conf.maxAttendees, conf.seatShards)
+    return [SeatShard(key=key, capacity=base + (1 if i < extra else 0))
+            for i, key in enumerate(shardKeys(conf))]
+
+
+def candidateShards(conf, reg=True):
+    """Return shard keys worth trying for a (un)registration, in random order.
+
+    This read is non-transactional; the transaction re-checks the shard.
+    """
+    shards = [s for s in ndb.get_multi(shardKeys(conf)) if s]
+    if reg:
+        shards = [s for s in shards if s.seatsTaken < s.capacity]
+    else:
+        shards = [s for s in shards if s.seatsTaken > 0]
+    random.shuffle(shards)
+    return [s.key for s in shards]
+
+
+def countSeatsAvailable(conf):
+    """Sum the shards of conf, refresh the cached value and return it."""
+    shards = [s for s in ndb.get_multi(shardKeys(conf)) if s]
+    seats = max(conf.maxAttendees - sum(s.seatsTaken for s in shards), 0)
+    memcache.set(MEMCACHE_SEATS_KEY % conf.key.urlsafe(), seats,
+                 time=SEATS_CACHE_TTL)
+    return seats
+
+
+def seatsAvailable(conf):
+    """Return seats available for conf, aggregated and cached if sharded."""
+    if not conf.seatShards:
+        memcache.set(MEMCACHE_SEATS_KEY % conf.key.urlsafe(),
+                     conf.seatsAvailable, time=SEATS_CACHE_TTL)
+        return conf.seatsAvailable
+    seats = memcache.get(MEMCACHE_SEATS_KEY % conf.key.urlsafe())
+    if seats is None:
+        seats = countSeatsAvailable(conf)
+    return seats
+
+
+def cachedSeatsAvailable(c_key):
+    """Return seats available for conference c_key, from memcache if
+    possible. Returns None if the conference does not exist."""
+    seats = memcache.get(MEMCACHE_SEATS_KEY % c_key.urlsafe())
+    if seats is None:
+        conf = c_key.get()
+        seats = seatsAvailable(conf) if conf else None
+    return seats
+
+
+def cachedSeatsAvailableMulti(c_keys):
+    """Return {c_key: seats available} for many conferences, from one
+    memcache get_multi; misses are read with one ndb.get_multi (plus one
+    for the shards of sharded conferences) and cached. Conferences that
+    do not exist are left out."""
+    wscks = dict((c_key.urlsafe(), c_key) for c_key in c_keys)
+    cached = memcache.get_multi(wscks.keys(), key_prefix=MEMCACHE_SEATS_KEY % '')
+    found = dict((wscks[wsck], seats) for wsck, seats in cached.iteritems())
+
+    missing = [c_key for c_key in wscks.itervalues() if c_key not in found]
+    confs = [conf for conf in ndb.get_multi(missing) if conf]
+    sharded = [conf for conf in confs if conf.seatShards]
+    shards = {}
+    if sharded:
+        s_keys = [key for conf in sharded for key in shardKeys(conf)]
+        shards = dict((key, shard) for key, shard in
+                      zip(s_keys, ndb.get_multi(s_keys)) if shard)
+    fresh = {}
+    for conf in confs:
+        if conf.seatShards:
+            taken = sum(shards[key].seatsTaken for key in shardKeys(conf)
+                        if key in shards)
+            fresh[conf.key] = max(conf.maxAttendees - taken, 0)
+        else:
+            fresh[conf.key] = conf.seatsAvailable
+    if fresh:
+        memcache.set_multi(dict((c_key.urlsafe(), seats)
+                                for c_key, seats in fresh.iteritems()),
+                           time=SEATS_CACHE_TTL,
+                           key_prefix=MEMCACHE_SEATS_KEY % '')
+    found.update(fresh)
+    return found
+
+
+def adjustCachedSeats(conf, delta):
+    """Apply a committed seat change to the cached aggregate, if present.
+
+    Returns the new cached value, or None if nothing was cached.
+    """
+    key = MEMCACHE_SEATS_KEY % conf.key.urlsafe()
+    if delta < 0:
+        return memcache.decr(key, -delta)
+    return memcache.incr(key, delta)
+
+
+@ndb.tasklet
+def syncSeatsAvailableAsync(conf):
+    """Fold the shard totals of conf back onto its stored seatsAvailable
+    and refresh the cached value; tasklet returning the seats available.
+
+    Only seatsAvailable is written, on a fresh read of the Conference in a
+    transaction, so edits made since conf was read are kept.
+    """
+    shards = yield ndb.get_multi_async(shardKeys(conf))
+    seats = yield _storeSeatsTakenAsync(
+        conf.key, sum(s.seatsTaken for s in shards if s))
+    if seats is not None:
+        yield ndb.get_context().memcache_set(
+            MEMCACHE_SEATS_KEY % conf.key.urlsafe(), seats,
+            time=SEATS_CACHE_TTL)
+    raise ndb.Return(seats)
+
+
+@ndb.transactional_tasklet
+def _storeSeatsTakenAsync(c_key, taken):
+    conf = yield c_key.get_async()
+    if not conf:
+        raise ndb.Return(None)
+    seats = max(conf.maxAttendees - taken, 0)
+    if conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        yield conf.put_async()
+    raise ndb.Return(seats)
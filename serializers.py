@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Compiled entity -> ProtoRPC message serializers.
+
+The field mapping between an ndb Model and a Message is worked out once
+per (Model, Message) pair and kept in a registry; serializing an entity
+then only runs the precompiled getters instead of reflecting over
+all_fields() with hasattr/endswith checks every time.
+
+"""
+
+import operator
+
+_special = {}
+_compiled = {}
+
+
+def _stringify(getter):
+    # Date/Time properties go out as strings, exactly as str() prints them
+    return lambda entity: str(getter(entity))
+
+
+class Serializer(object):
+    """Precompiled field plan copying one Model kind into one Message."""
+
+    def __init__(self, model_class, message_class, special=None):
+        special = special or {}
+        self.message_class = message_class
+        plan = []
+        for field in message_class.all_fields():
+            name = field.name
+            if name in special:
+                # None marks a field the caller fills in (or leaves empty)
+                if special[name] is not None:
+                    plan.append((name, special[name]))
+            elif hasattr(model_class, name):
+                getter = operator.attrgetter(name)
+                if name.endswith('Date') or name.endswith('Time'):
+                    getter = _stringify(getter)
+                plan.append((name, getter))
+        self.plan = tuple(plan)
+        self.check = any(field.required for field in message_class.all_fields())
+
+    def __call__(self, entity, **extra):
+        """Return entity as a message; extra sets fields to fixed values."""
+        msg = self.message_class()
+        for name, getter in self.plan:
+            value = getter(entity)
+            if value is not None:
+                setattr(msg, name, value)
+        for name, value in extra.iteritems():
+            if value:
+                setattr(msg, name, value)
+        if self.check:
+            msg.check_initialized()
+        return msg
+
+    def many(self, entities, **extra):
+        """Return messages for entities, skipping missing (None) ones."""
+        return [self(entity, **extra) for entity in entities
+                if entity is not None]
+
+
+def register(model_class, message_class, **special):
+    """Declare special field getters for a (Model, Message) pair.
+
+    Each keyword maps a message field to a function of the entity, or to
+    None for a field the serializer should leave alone.
+    """
+    _special[(model_class, message_class)] = special
+    _compiled.pop((model_class, message_class), None)
+
+
+def serializer(model_class, message_class):
+    """Return the compiled Serializer for a (Model, Message) pair."""
+    pair = (model_class, message_class)
+    compiled = _compiled.get(pair)
+    if compiled is None:
+        compiled = _compiled[pair] = Serializer(model_class, message_class,
+                                                _special.get(pair))
+    return compiled
+
+
+def serialize(entity, message_class, **extra):
+    """Return entity as a message_class message."""
+    return serializer(type(entity), message_class)(entity, **extra)
+
+
+def serialize_many(entities, message_class, **extra):
+    """Return entities (all of one kind) as message_class messages."""
+    entities = [entity for entity in entities if entity is not None]
+    if not entities:
+        return []
+    return serializer(type(entities[0]), message_class).many(entities, **extra)
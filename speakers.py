@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+Speaker bookkeeping: the speaker directory and featured speakers.
+
+Every Session created is added to its Speaker, a root entity keyed by the
+normalized speaker name (case and spacing folded) holding the keys of all
+their sessions across conferences, so a speaker's sessions are one get
+plus one get_multi.
+
+It also bumps a ConferenceSpeaker counter (a child of its Conference,
+keyed by the same normalized name) in a small transaction. A speaker with more than one
+session at a conference becomes that conference's featured speaker,
+cached in memcache together with their session names.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import ConferenceSpeaker
+from models import Speaker
+
+MEMCACHE_SPEAKER_KEY = "FEATURED SPEAKER %s"
+
+
+def normalizeSpeaker(name):
+    """Return the directory id of speaker name: lowercased, with runs of
+    whitespace folded to single spaces."""
+    return u' '.join((name or u'').lower().split())
+
+
+def directoryKey(name):
+    """Return the Speaker key of speaker name (in any case/spacing)."""
+    return ndb.Key(Speaker, normalizeSpeaker(name))
+
+
+@ndb.transactional_tasklet
+def addSessionsAsync(name, s_keys):
+    """Add Sessions s_keys to the Speaker of name, creating it if needed.
+
+    Safe to retry: sessions already listed are not added again.
+    """
+    key = directoryKey(name)
+    speaker = yield key.get_async()
+    if not speaker:
+        speaker = Speaker(key=key, name=u' '.join(name.split()))
+    new = [s_key for s_key in s_keys if s_key not in speaker.sessionKeys]
+    if new:
+        speaker.sessionKeys.extend(new)
+        speaker.sessionCount = len(speaker.sessionKeys)
+        yield speaker.put_async()
+    raise ndb.Return(speaker)
+
+
+@ndb.transactional
+def replaceSession(name, old, new):
+    """Replace session key old by new on the Speaker of name."""
+    speaker = directoryKey(name).get()
+    if speaker and old in speaker.sessionKeys:
+        speaker.sessionKeys = [new if s_key == old else s_key
+                               for s_key in speaker.sessionKeys
+                               if s_key != new]
+        speaker.sessionCount = len(speaker.sessionKeys)
+        speaker.put()
+
+
+def addSessionsBySpeakerAsync(sessions):
+    """Add sessions (Session entities) to their Speakers, one transaction
+    per speaker; return a Future for each."""
+    byName = {}
+    for sess in sessions:
+        if normalizeSpeaker(sess.speaker):
+            byName.setdefault(normalizeSpeaker(sess.speaker),
+                              (sess.speaker, []))[1].append(sess.key)
+    return [addSessionsAsync(name, s_keys)
+            for name, s_keys in byName.itervalues()]
+
+
+def speakerKey(c_key, speaker):
+    """Return the ConferenceSpeaker key for speaker (in any case/spacing)
+    at conference c_key."""
+    return ndb.Key(ConferenceSpeaker, normalizeSpeaker(speaker), parent=c_key)
+
+
+@ndb.transactional
+def countSession(c_key, speaker, s_key, sessionName):
+    """Count Session s_key for speaker at c_key; return the counter.
+
+    Safe to retry: a session already counted is not counted again.
+    """
+    counter = speakerKey(c_key, speaker).get()
+    if not counter:
+        counter = ConferenceSpeaker(key=speakerKey(c_key, speaker),
+                                    speaker=u' '.join(speaker.split()))
+    if s_key not in counter.sessionKeys:
+        counter.sessionKeys.append(s_key)
+        counter.sessionNames.append(sessionName)
+        counter.sessionCount = len(counter.sessionKeys)
+        counter.put()
+    return counter
+
+
+@ndb.transactional
+def recountSession(c_key, speaker, old, new, sessionName):
+    """Count Session new for speaker at c_key in place of key old, if old
+    was counted; return the counter."""
+    counter = speakerKey(c_key, speaker).get()
+    if counter and old in counter.sessionKeys:
+        index = counter.sessionKeys.index(old)
+        counter.sessionKeys[index] = new
+        counter.put()
+        return counter
+    return countSession(c_key, speaker, new, sessionName)
+
+
+def formatFeatured(counter):
+    """Return the featured speaker announcement for a counter."""
+    return '%s: %s' % (counter.speaker, ', '.join(counter.sessionNames))
+
+
+def cacheFeaturedSpeaker(c_key, counter):
+    """Feature counter's speaker for c_key in memcache if they qualify."""
+    if counter.sessionCount > 1:
+        featured = formatFeatured(counter)
+        memcache.set(MEMCACHE_SPEAKER_KEY % c_key.urlsafe(), featured)
+        return featured
+    return None
+
+
+def featuredSpeaker(c_key):
+    """Return featured speaker of conference c_key, or "" if none.
+
+    Falls back to the speaker with most sessions if memcache lost it.
+    """
+    featured = memcache.get(MEMCACHE_SPEAKER_KEY % c_key.urlsafe())
+    if featured is None:
+        counter = ConferenceSpeaker.query(ancestor=c_key).order(
+            -ConferenceSpeaker.sessionCount).get()
+        featured = counter and cacheFeaturedSpeaker(c_key, counter)
+        if not featured:
+            # remember there is none; add() won't clobber a fresh speaker
+            featured = ""
+            memcache.add(MEMCACHE_SPEAKER_KEY % c_key.urlsafe(), featured)
+    return featured
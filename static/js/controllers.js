@@ -17,6 +17,13 @@ var conferenceApp = conferenceApp || {};
  */
 conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstrap']);
 
+/**
+ * How often the conference list refreshes the seats of the conferences on screen.
+ *
+ * @type {number}
+ */
+var SEATS_POLL_INTERVAL_MS = 30000;
+
 /**
  * @ngdoc controller
  * @name MyProfileCtrl
@@ -249,7 +256,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $interval, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -341,32 +348,85 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Namespace for the pagination.
+     * Pages are fetched from the server one at a time; cursors[i] holds the cursor
+     * that starts page i, and nextCursor the cursor returned with the current page.
      * @type {{}|*}
      */
     $scope.pagination = $scope.pagination || {};
     $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
+    $scope.pagination.cursors = [null];
+    $scope.pagination.nextCursor = null;
+
     /**
-     * Returns the number of the pages in the pagination.
+     * Resets the pagination to the first page.
+     */
+    $scope.pagination.reset = function () {
+        $scope.pagination.currentPage = 0;
+        $scope.pagination.cursors = [null];
+        $scope.pagination.nextCursor = null;
+    };
+
+    /**
+     * Returns the request parameters for the current page.
      *
-     * @returns {number}
+     * @returns {{pageSize: number}}
      */
-    $scope.pagination.numberOfPages = function () {
-        return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
+    $scope.pagination.params = function () {
+        var params = {pageSize: $scope.pagination.pageSize};
+        var cursor = $scope.pagination.cursors[$scope.pagination.currentPage];
+        if (cursor) {
+            params.cursor = cursor;
+        }
+        return params;
     };
 
     /**
-     * Returns an array including the numbers from 1 to the number of the pages.
+     * Returns true if there is a page after the current one.
      *
-     * @returns {Array}
+     * @returns {boolean}
+     */
+    $scope.pagination.hasNext = function () {
+        return !!$scope.pagination.nextCursor;
+    };
+
+    /**
+     * Moves to the first page and fetches it.
      */
-    $scope.pagination.pageArray = function () {
-        var pages = [];
-        var numberOfPages = $scope.pagination.numberOfPages();
-        for (var i = 0; i < numberOfPages; i++) {
-            pages.push(i);
+    $scope.pagination.first = function () {
+        $scope.pagination.currentPage = 0;
+        $scope.fetchPage();
+    };
+
+    /**
+     * Moves to the previous page and fetches it.
+     */
+    $scope.pagination.previous = function () {
+        if ($scope.pagination.currentPage > 0) {
+            $scope.pagination.currentPage--;
+            $scope.fetchPage();
         }
-        return pages;
+    };
+
+    /**
+     * Moves to the next page and fetches it.
+     */
+    $scope.pagination.next = function () {
+        if ($scope.pagination.hasNext()) {
+            $scope.pagination.currentPage++;
+            $scope.pagination.cursors[$scope.pagination.currentPage] = $scope.pagination.nextCursor;
+            $scope.fetchPage();
+        }
+    };
+
+    /**
+     * Stores the cursor for the page after the one just received.
+     *
+     * @param resp the response of a paged conference query
+     */
+    $scope.pagination.update = function (resp) {
+        $scope.pagination.nextCursor = resp.nextCursor || null;
+        $scope.pagination.cursors.length = $scope.pagination.currentPage + 1;
     };
 
     /**
@@ -413,6 +473,15 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      *
      */
     $scope.queryConferences = function () {
+        $scope.pagination.reset();
+        $scope.fetchPage();
+    };
+
+    /**
+     * Fetches the current page of conferences for the selected tab.
+     *
+     */
+    $scope.fetchPage = function () {
         $scope.submitted = false;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
@@ -427,9 +496,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      * Invokes the conference.queryConferences API.
      */
     $scope.queryConferencesAll = function () {
-        var sendFilters = {
-            filters: []
-        }
+        var sendFilters = $scope.pagination.params();
+        sendFilters.filters = [];
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
             if (filter.field && filter.operator && filter.value) {
@@ -462,6 +530,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.pagination.update(resp);
                     }
                     $scope.submitted = true;
                 });
@@ -473,7 +542,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated($scope.pagination.params()).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -499,6 +568,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.pagination.update(resp);
                     }
                     $scope.submitted = true;
                 });
@@ -511,7 +581,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        gapi.client.conference.getConferencesToAttend($scope.pagination.params()).
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
@@ -527,7 +597,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        $scope.conferences = resp.result.items || [];
+                        $scope.pagination.update(resp.result);
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
@@ -537,6 +608,42 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             });
     };
+
+    /**
+     * Polls the conference.getSeatsAvailable method to keep the seats of the conferences on screen
+     * current without fetching the conferences again.
+     */
+    $scope.refreshSeats = function () {
+        if (!$scope.conferences.length) {
+            return;
+        }
+        var keys = $scope.conferences.map(function (conference) {
+            return conference.websafeKey;
+        });
+        gapi.client.conference.getSeatsAvailable({websafeConferenceKeys: keys}).
+            execute(function (resp) {
+                if (resp.error) {
+                    $log.error('Failed to refresh seats : ' + (resp.error.message || ''));
+                    return;
+                }
+                $scope.$apply(function () {
+                    var seats = {};
+                    angular.forEach(resp.items, function (item) {
+                        seats[item.websafeConferenceKey] = item.seatsAvailable;
+                    });
+                    angular.forEach($scope.conferences, function (conference) {
+                        if (conference.websafeKey in seats) {
+                            conference.seatsAvailable = seats[conference.websafeKey];
+                        }
+                    });
+                });
+            });
+    };
+
+    var seatsPoller = $interval($scope.refreshSeats, SEATS_POLL_INTERVAL_MS);
+    $scope.$on('$destroy', function () {
+        $interval.cancel(seatsPoller);
+    });
 });
 
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""textindex.py
+
+Keyword search over Conferences and Sessions, on an inverted index kept
+in the datastore.
+
+Each distinct term of an entity is one SearchPosting whose `term` is
+'<Kind> <term>' (so a single-property index serves every kind) and whose
+weight adds up the weights of the fields the term occurs in. A query
+token of at least MIN_PREFIX_LENGTH characters matches the postings of
+every term it is a prefix of, found with one range query per token; a
+shorter one only its own term. Entities must match all tokens and are
+ranked by the sum of their matching weights, exact terms counting fully,
+prefix matches PREFIX_WEIGHT, and terms found in many entities counting
+less.
+
+Reads are bounded: at most MAX_POSTINGS postings are read per token, and
+a query's ranking is kept in memcache for RANKING_TTL seconds, so paging
+through the hits does not rank them again for every page.
+
+The index is written incrementally as entities are created; reindexAsync
+rebuilds the postings of existing entities.
+
+"""
+
+import hashlib
+import math
+import re
+
+from google.appengine.ext import ndb
+
+from models import SearchPosting
+
+MAX_TERM_LENGTH = 50
+MIN_PREFIX_LENGTH = 3
+POSTINGS_PAGE_SIZE = 1000
+MAX_POSTINGS = 5000
+RANKING_TTL = 60
+MEMCACHE_RANKING_KEY = "SEARCH RANKING %s"
+PREFIX_WEIGHT = 0.5
+STOP_WORDS = frozenset(['a', 'an', 'and', 'at', 'for', 'in', 'of', 'on',
+                        'or', 'the', 'to', 'with'])
+
+# field -> weight of a term occurring in it, per indexed kind
+FIELD_WEIGHTS = {
+    'Conference': {'name': 3.0, 'topics': 2.0, 'city': 2.0,
+                   'description': 1.0},
+    'Session': {'sessionName': 3.0, 'speaker': 2.0, 'typeOfSession': 1.0,
+                'highlights': 1.0},
+}
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the lowercased index terms of text, in order."""
+    return [token[:MAX_TERM_LENGTH] for token in
+            _TOKEN_RE.findall((text or u'').lower())
+            if token not in STOP_WORDS]
+
+
+def _termWeights(entity):
+    """Return {term: weight} for entity's indexed fields."""
+    weights = {}
+    for field, weight in FIELD_WEIGHTS[entity._get_kind()].iteritems():
+        value = getattr(entity, field)
+        for text in (value if isinstance(value, list) else [value]):
+            for term in set(tokenize(text)):
+                weights[term] = weights.get(term, 0.0) + weight
+    return weights
+
+
+def _postingTerm(kind, term):
+    return u'%s %s' % (kind, term)
+
+
+def postings(entity):
+    """Return the SearchPostings indexing entity."""
+    kind = entity._get_kind()
+    doc = entity.key.urlsafe()
+    return [SearchPosting(id=u'%s|%s' % (_postingTerm(kind, term), doc),
+                          term=_postingTerm(kind, term), doc=entity.key,
+                          weight=weight)
+            for term, weight in _termWeights(entity).iteritems()]
+
+
+@ndb.tasklet
+def indexAsync(entities):
+    """Add entities (Conferences/Sessions) to the index."""
+    batch = [p for entity in entities for p in postings(entity)]
+    if batch:
+        yield ndb.put_multi_async(batch)
+
+
+@ndb.tasklet
+def unindexAsync(keys):
+    """Remove the postings of the entities with keys from the index."""
+    old = yield [SearchPosting.query(SearchPosting.doc == key)
+                 .fetch_async(keys_only=True) for key in keys]
+    yield ndb.delete_multi_async([key for found in old for key in found])
+
+
+@ndb.tasklet
+def reindexAsync(entities):
+    """Replace the postings of already indexed entities."""
+    old = yield [SearchPosting.query(SearchPosting.doc == entity.key)
+                 .fetch_async(keys_only=True) for entity in entities]
+    yield ndb.delete_multi_async([key for keys in old for key in keys])
+    yield indexAsync(entities)
+
+
+@ndb.tasklet
+def _matchToken(kind, token):
+    """Return {doc key: score} of entities matching token (or a term it
+    is a prefix of), reading up to MAX_POSTINGS postings a page at a time."""
+    start = _postingTerm(kind, token)
+    if len(token) < MIN_PREFIX_LENGTH:
+        # a short prefix would expand to much of the index
+        query = SearchPosting.query(SearchPosting.term == start)
+    else:
+        query = SearchPosting.query(SearchPosting.term >= start,
+                                    SearchPosting.term < start + u'\ufffd')
+    scores = {}
+    cursor, more, read = None, True, 0
+    while more and read < MAX_POSTINGS:
+        found, cursor, more = yield query.fetch_page_async(
+            min(POSTINGS_PAGE_SIZE, MAX_POSTINGS - read), start_cursor=cursor)
+        read += len(found)
+        for posting in found:
+            exact = posting.term == start
+            score = posting.weight * (1.0 if exact else PREFIX_WEIGHT)
+            scores[posting.doc] = max(scores.get(posting.doc, 0.0), score)
+        more = more and cursor is not None
+    # rarer tokens tell more about an entity
+    idf = 1.0 / math.log(2 + len(scores))
+    raise ndb.Return(dict((doc, score * idf)
+                          for doc, score in scores.iteritems()))
+
+
+@ndb.tasklet
+def searchAsync(kind, text, keep=None):
+    """Return keys of kind entities matching every token of text, best
+    match first.
+
+    keep, if given, is called with each candidate key to filter them.
+    """
+    tokens = sorted(set(tokenize(text)))
+    if not tokens:
+        raise ndb.Return([])
+    ctx = ndb.get_context()
+    key = MEMCACHE_RANKING_KEY % hashlib.sha1(
+        _postingTerm(kind, u' '.join(tokens)).encode('utf-8')).hexdigest()
+    ranked = yield ctx.memcache_get(key)
+    if ranked is None:
+        ranked = yield _rankAsync(kind, tokens)
+        yield ctx.memcache_set(key, ranked, time=RANKING_TTL)
+    if keep:
+        ranked = [doc for doc in ranked if keep(doc)]
+    raise ndb.Return(ranked)
+
+
+@ndb.tasklet
+def _rankAsync(kind, tokens):
+    """Return keys of kind entities matching every one of tokens, best
+    match first."""
+    matches = yield [_matchToken(kind, token) for token in tokens]
+    docs = set(matches[0])
+    for scores in matches[1:]:
+        docs.intersection_update(scores)
+    ranked = sorted(docs, key=lambda doc: (
+        -sum(scores[doc] for scores in matches), doc.urlsafe()))
+    raise ndb.Return(ranked)
+
@@ -1,38 +1,122 @@
+import collections
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 
-from google.appengine.api import urlfetch
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+MEMCACHE_TOKEN_KEY = "TOKEN %s"
+TOKEN_CACHE_SIZE = 1000
+TOKEN_MAX_TTL = 60 * 60
+INVALID_TOKEN_TTL = 60
+
+
+class _TokenCache(object):
+    """Small thread-safe per-instance LRU of token -> (userId, expiry)."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return None
+            # re-insert as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, user_id, expiry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (user_id, expiry)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+_token_cache = _TokenCache(TOKEN_CACHE_SIZE)
+
+
+def _cacheToken(key, user_id, ttl):
+    """Remember a verified (or, with user_id '', rejected) token until it
+    expires."""
+    expiry = time.time() + ttl
+    _token_cache.set(key, user_id, expiry)
+    memcache.set(MEMCACHE_TOKEN_KEY % key, (user_id, expiry), time=ttl)
+
+
+@ndb.tasklet
+def _fetchTokenUserId(token):
+    """Ask tokeninfo who owns token; return (userId, ttl).
+
+    userId is '' for a token tokeninfo rejects, None if it could not be
+    checked at all. Runs on the ndb event loop, so retries back off
+    without blocking the request thread.
+    """
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    url = TOKENINFO_URL % (token_type, token)
+    wait = 1
+    for i in range(3):
+        resp = yield ndb.get_context().urlfetch(url)
+        if resp.status_code == 200:
+            user = json.loads(resp.content)
+            ttl = min(int(user.get('expires_in', TOKEN_MAX_TTL)), TOKEN_MAX_TTL)
+            raise ndb.Return((user.get('user_id', ''), ttl))
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            if token_type == 'access_token':
+                raise ndb.Return(('', INVALID_TOKEN_TTL))
+            token_type = 'access_token'
+            url = TOKENINFO_URL % (token_type, token)
+        else:
+            yield ndb.sleep(wait)
+            wait = wait + i
+    raise ndb.Return((None, 0))
+
+
+@ndb.tasklet
+def getUserIdAsync(user, id_type="email"):
+    """Tasklet version of getUserId; yield it (or call get_result() on the
+    returned future) so token verification overlaps other RPCs."""
+    if id_type != "oauth":
+        raise ndb.Return(getUserId(user, id_type))
+
+    auth = os.getenv('HTTP_AUTHORIZATION')
+    bearer, token = auth.split()
+    key = hashlib.sha256(token).hexdigest()
+
+    # per-instance LRU first, then memcache, then tokeninfo itself
+    user_id = _token_cache.get(key)
+    if user_id is None:
+        cached = yield ndb.get_context().memcache_get(MEMCACHE_TOKEN_KEY % key)
+        if cached is not None:
+            user_id, expiry = cached
+            _token_cache.set(key, user_id, expiry)
+    if user_id is None:
+        user_id, ttl = yield _fetchTokenUserId(token)
+        if user_id is None:
+            # tokeninfo unreachable; don't cache, let the next request retry
+            user_id = ''
+        elif ttl > 0:
+            _cacheToken(key, user_id, ttl)
+    raise ndb.Return(user_id)
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
 
     if id_type == "oauth":
         """A workaround implementation for getting userid."""
-        auth = os.getenv('HTTP_AUTHORIZATION')
-        bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getUserIdAsync(user, id_type).get_result()
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
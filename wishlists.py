@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""wishlists.py
+
+Session wishlists stored as WishlistEntry entities.
+
+A WishlistEntry is a child of the user's Profile whose id is the websafe
+session key, so a session can only be on a wishlist once and adding or
+removing it never rewrites the Profile.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import WishlistEntry
+
+
+def entryKey(p_key, wssk):
+    """Return the WishlistEntry key of profile p_key for session wssk."""
+    return ndb.Key(WishlistEntry, wssk, parent=p_key)
+
+
+def wishlistQuery(p_key):
+    """Return a keys-only-friendly query for the wishlist of p_key."""
+    return WishlistEntry.query(ancestor=p_key)
+
+
+def sessionKeys(p_key):
+    """Return keys of all sessions on the wishlist of p_key."""
+    return [ndb.Key(urlsafe=e_key.id()) for e_key in
+            wishlistQuery(p_key).fetch(keys_only=True)]
+
+
+@ndb.transactional
+def add(p_key, s_key):
+    """Add session s_key to the wishlist of p_key.
+
+    Returns False if it was already there.
+    """
+    e_key = entryKey(p_key, s_key.urlsafe())
+    if e_key.get():
+        return False
+    WishlistEntry(key=e_key, session=s_key).put()
+    return True
+
+
+@ndb.transactional
+def remove(p_key, s_key):
+    """Remove session s_key from the wishlist of p_key.
+
+    Returns False if it was not there.
+    """
+    e_key = entryKey(p_key, s_key.urlsafe())
+    if not e_key.get():
+        return False
+    e_key.delete()
+    return True
+
+
+def profilesWithSession(s_key):
+    """Return keys of the profiles with session s_key on their wishlist."""
+    return [e_key.parent() for e_key in
+            WishlistEntry.query(WishlistEntry.session == s_key)
+            .fetch(keys_only=True)]
+
+
+@ndb.transactional
+def replaceSession(p_key, old, new):
+    """Point the wishlist entry of p_key for session key old at new."""
+    e_key = entryKey(p_key, old.urlsafe())
+    if e_key.get():
+        e_key.delete()
+        WishlistEntry(key=entryKey(p_key, new.urlsafe()), session=new).put()
+
+
+@ndb.transactional
+def migrateProfile(p_key):
+    """Move a Profile's legacy sessionWishlistKeys list into WishlistEntry
+    entities. Returns the number of entries written."""
+    prof = p_key.get()
+    if not prof or not prof.sessionWishlistKeys:
+        return 0
+    entries = [WishlistEntry(key=entryKey(p_key, wssk),
+                             session=ndb.Key(urlsafe=wssk))
+               for wssk in set(prof.sessionWishlistKeys)]
+    prof.sessionWishlistKeys = []
+    ndb.put_multi(entries + [prof])
+    return len(entries)